@@ -1,15 +1,139 @@
 import os
+import tempfile
 import numpy as np
 import healpy as hp
 
 
+# Column layouts of the spectrum files produced by CAMB. The first column
+# is always the multipole :math:`l`, the rest are :math:`D_{l}` values.
+_SPECTRUM_LAYOUTS = {
+    'scalcls' : ['TT', 'EE', 'TE', 'PP', 'TP'],
+    'totalcls' : ['TT', 'EE', 'BB', 'TE'],
+    'lensedcls' : ['TT', 'EE', 'BB', 'TE'],
+}
+
+
+def _guess_layout(fname):
+    """
+    Guesses the column names of a spectrum file from its name. Files with
+    an unknown name are assumed to contain a single TT column.
+    """
+    name = os.path.basename(fname).lower()
+    for key, layout in _SPECTRUM_LAYOUTS.items():
+        if key in name:
+            return layout
+    return ['TT']
+
+
+class SpectrumRegistry:
+    """
+    Registry of angular power spectrum files. Every text file is parsed only
+    once, then stored in a binary `.npz` sidecar next to it (`{fname}.npz`),
+    which is used on all subsequent loads. The sidecar is rebuilt whenever the
+    modification time and size (or, optionally, the SHA-1 hash) of the text
+    file differ from the ones recorded in it.
+    
+    Parameters
+    ----------
+    use_hash : bool
+        If `True`, sidecars are validated by the SHA-1 hash of the source file
+        instead of its modification time and size.
+    write_sidecar : bool
+        If `False`, parsed spectra are only cached in memory.
+    """
+    def __init__(self, use_hash=False, write_sidecar=True):
+        self.use_hash = use_hash
+        self.write_sidecar = write_sidecar
+        self._cache = {}
+    
+    def _signature(self, fname):
+        if self.use_hash:
+            import hashlib
+            with open(fname, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        st = os.stat(fname)
+        return f'{st.st_mtime_ns}:{st.st_size}'
+    
+    def _load_table(self, fname):
+        """
+        Returns the full parsed table of `fname`, from memory, from the sidecar
+        or from the text file, in this order of preference.
+        """
+        sig = self._signature(fname)
+        if fname in self._cache and self._cache[fname][0] == sig:
+            return self._cache[fname][1]
+        
+        sidecar = fname + '.npz'
+        table = None
+        if os.path.exists(sidecar):
+            with np.load(sidecar) as npz:
+                if str(npz['signature']) == sig:
+                    table = npz['table']
+        if table is None:
+            table = np.loadtxt(fname, ndmin=2)
+            if self.write_sidecar:
+                # A unique temporary name, so concurrent loads never share a partial file
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(sidecar) or '.',
+                                           prefix=os.path.basename(sidecar) + '.', suffix='.part')
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, table=table, signature=np.array(sig))
+                os.replace(tmp, sidecar)
+        
+        self._cache[fname] = (sig, table)
+        return table
+    
+    def get(self, fname, lmax=None, columns=('TT',), layout=None):
+        """
+        Serves a set of spectrum columns of a file up to a given bandlimit.
+        
+        Parameters
+        ----------
+        fname : str
+            Path to the spectrum file.
+        lmax : int
+            Bandlimit of the returned spectra. If `None`, every multipole in
+            the file is returned.
+        columns : str or list of str
+            Names of the columns to return, e.g. 'TT', 'EE', 'BB', 'TE' or 'PP'.
+        layout : list of str
+            Column names of the file following the multipole column. If
+            `None`, it is guessed from the filename.
+        
+        Returns
+        -------
+        ell : numpy.array
+            Multipoles of the spectra up to :math:`l_{\mathrm{max}}`.
+        Dl : numpy.ndarray of shape (len(columns), len(ell)) or (len(ell), )
+            The requested :math:`D_{l}` columns. A single column is returned
+            as a 1D array if `columns` was given as a string.
+        """
+        assert os.path.exists(fname), f"There is no file named `{fname}`"
+        layout = _guess_layout(fname) if layout is None else list(layout)
+        single = isinstance(columns, str)
+        columns = [columns] if single else list(columns)
+        for c in columns:
+            assert c in layout, f"Column `{c}` is not in the file, available columns are : {layout}"
+        
+        table = self._load_table(fname)
+        ell = table[:, 0]
+        n = ell.size if lmax is None else np.searchsorted(ell, lmax, side='right')
+        Dl = table[:n, [1 + layout.index(c) for c in columns]].T
+        
+        return ell[:n], (Dl[0] if single else Dl)
+
+
+# Default registry shared by the loaders of this module
+registry = SpectrumRegistry()
+
+
 def load_spectrum(fname, lmax=None):
     """
     Loads and arbitrary angular power spectrum from a file.
 
     Datasets generated with the LAMBDA tool contains only the :math:`D_{l}`
     values, alongside the array of the :math:`l` multipoles and the
-    corresponding errors.
+    corresponding errors. The file is parsed only once, subsequent calls
+    are served by the `registry` from a binary cache.
 
     Parameters
     ----------
@@ -23,6 +147,7 @@ def load_spectrum(fname, lmax=None):
     lmax : int
         Bandlimit of the angular power spectrum. The spectrum will be
         read in up to the spherical harmonic order :math:`l_{\mathrm{max}}`.
+        If `None`, the whole file is read in.
 
     Returns
     -------
@@ -31,17 +156,17 @@ def load_spectrum(fname, lmax=None):
         were evaluated. Contains integers from 2 to :math:`l_{\mathrm{max}}`,
         where :math:`l_{\mathrm{max}}` is included.
     
+    ClTT : numpy.array
+        Angular power spectrum bins (:math:`C_{l}`) for every multipole
+        value in `ell`.
+    
     DlTT : numpy.array
         Transformed angular power spectrum bins (:math:`D_{l}`) for
         every multipole value in `ell`. The transformation is
         .. math::
                     D_{l} = \frac{l (l + 1)}{2 \pi} C_{l}.
     """
-    assert os.path.exists(fname), f"There is no file named `{fname}`"
-    
-    d = np.genfromtxt(fname, max_rows=lmax-1)
-    ell = d[:, 0]
-    DlTT = d[:, 1]
+    ell, DlTT = registry.get(fname, lmax=lmax, columns='TT', layout=['TT'])
     ClTT = DlTT * 2 * np.pi / (ell * (ell + 1))
     
     return ell, ClTT, DlTT
@@ -103,4 +228,123 @@ def gen_maps(cls, N_SIDE=2048, lmax=None,
         `alm` is possibly a list of :math:`a_{lm}` arrays if polarized input.
     """
     return hp.synfast(cls, nside=N_SIDE, lmax=lmax, pol=pol,
-                      pixwin=pixwin, fwhm=fwhm, sigma=sigma)
\ No newline at end of file
+                      pixwin=pixwin, fwhm=fwhm, sigma=sigma)
+
+
+def _write_atomic(path, write):
+    """
+    Writes a file through a uniquely named temporary `.part` file in the same
+    directory, which is only renamed to its final name after `write` finished.
+    An interrupted run therefore never leaves a truncated file behind under
+    the final name, and concurrent writers never share a temporary file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=os.path.basename(path) + '.', suffix='.part')
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _save_npy(path, arr):
+    """
+    Saves an array into a `.npy` file under exactly the given path (`np.save`
+    would append a `.npy` extension to the temporary `.part` files).
+    """
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+
+
+def gen_maps_batch(cls, seeds, out_dir, N_SIDE=2048, lmax=None,
+                   pol=False, pixwin=False, fwhm=5.8e-3, sigma=8.7e-6,
+                   alm=False, fmt='fits', prefix='cmb', overwrite=False):
+    """
+    Generates an ensemble of randomized HEALPix arrays one by one and writes
+    every realization straight to disk, instead of collecting them in memory.
+    Each realization is drawn with `hp.synfast` after seeding `numpy` with the
+    corresponding element of `seeds`, so every file can be regenerated alone.
+    `hp.synfast` draws from the global `numpy` random state and does not take
+    a generator, so the global state has to be seeded, but the state of the
+    caller is restored after every realization.
+    
+    Already existing outputs are skipped, thus an interrupted run can be
+    resumed simply by calling the routine again with the same arguments.
+    
+    Parameters
+    ----------
+    cls : array or tuple of arrays
+        Input angular power spectrum (or spectra), same as in `gen_maps`.
+    
+    seeds : iterable of int
+        Random seeds of the realizations. One map is generated per seed.
+    
+    out_dir : str
+        Path to the output folder. Created if it does not exist.
+    
+    N_SIDE, lmax, pol, pixwin, fwhm, sigma
+        Passed to `hp.synfast`, see `gen_maps` for details.
+    
+    alm : bool
+        If `True`, the :math:`a_{lm}` coefficients of every realization are
+        saved next to the maps too.
+    
+    fmt : str
+        Output format of the files. Can be either of the following:
+            - 'fits' : single precision HEALPix FITS tables
+            - 'npy' : single precision `numpy` binary files
+    
+    prefix : str
+        Prefix of the output filenames. Files are named as
+        `{prefix}_{seed:06d}_map.{fmt}` and `{prefix}_{seed:06d}_alm.{fmt}`.
+    
+    overwrite : bool
+        If `True`, existing files are regenerated instead of being skipped.
+    
+    Yields
+    ------
+    meta : dict
+        Metadata of the actual realization with the keys `seed`, `map`
+        (path to the map file), `alm` (path to the :math:`a_{l m}` file
+        or `None`) and `resumed` (`True` if the files already existed).
+    """
+    _POSSIBLE_FMT = ['fits', 'npy']
+    assert fmt in _POSSIBLE_FMT, f"Available formats are : {_POSSIBLE_FMT}"
+    os.makedirs(out_dir, exist_ok=True)
+    
+    for seed in seeds:
+        base = os.path.join(out_dir, f'{prefix}_{seed:06d}')
+        map_path = f'{base}_map.{fmt}'
+        alm_path = f'{base}_alm.{fmt}' if alm else None
+        
+        done = [p for p in (map_path, alm_path) if p is not None]
+        if not overwrite and all(os.path.exists(p) for p in done):
+            yield {'seed' : seed, 'map' : map_path, 'alm' : alm_path, 'resumed' : True}
+            continue
+        
+        state = np.random.get_state()
+        try:
+            np.random.seed(seed)
+            res = hp.synfast(cls, nside=N_SIDE, lmax=lmax, pol=pol, alm=alm,
+                             pixwin=pixwin, fwhm=fwhm, sigma=sigma)
+        finally:
+            np.random.set_state(state)
+        maps, alms = res if alm else (res, None)
+        maps = np.asarray(maps, dtype=np.float32)
+        
+        if fmt == 'fits':
+            _write_atomic(map_path, lambda p: hp.write_map(p, maps, dtype=np.float32,
+                                                            overwrite=True))
+            if alm:
+                _write_atomic(alm_path, lambda p: hp.write_alm(p, alms, overwrite=True))
+        else:
+            _write_atomic(map_path, lambda p: _save_npy(p, maps))
+            if alm:
+                _write_atomic(alm_path, lambda p: _save_npy(p, np.asarray(alms, dtype=np.complex64)))
+        
+        # Drop the realization before the next one is drawn
+        del maps, alms, res
+        yield {'seed' : seed, 'map' : map_path, 'alm' : alm_path, 'resumed' : False}
@@ -1,12 +1,15 @@
 import os
+import tempfile
 import numpy as np
 import healpy as hp
-from functools import partial
+from functools import partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import astropy.io.fits as fits
 
 import matplotlib as mpl
 import matplotlib.cm as cm
+import matplotlib.image as mpimg
 import matplotlib.mlab as mlab
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
@@ -63,21 +66,155 @@ def load_HPX(file, field=1):
     return hpx, hpx_muK, header
 
 
+class PartialHPX:
+    """
+    Compact representation of a partial-sky HEALPix map, which stores only
+    the observed (unmasked) pixels as pairs of RING ordered `int64` pixel
+    indices and `float32` values. The memory footprint therefore scales with
+    the observed sky fraction, instead of the full :math:`12 N_{side}^{2}`.
+    
+    The object can be indexed with pixel numbers like a full map, thus it
+    can be passed directly to `get_projection`. A full map is only created
+    by `to_full`, e.g. when a spherical harmonic transform requires it.
+    
+    Parameters
+    ----------
+    N_SIDE : int
+        The number of pixels per side in the HEALPix projection.
+    pixels : numpy.ndarray of shape (N_obs, )
+        RING ordered indices of the observed pixels.
+    values : numpy.ndarray of shape (N_obs, )
+        Map values in the observed pixels.
+    """
+    def __init__(self, N_SIDE, pixels, values):
+        pixels = np.asarray(pixels, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float32)
+        assert pixels.shape == values.shape, "`pixels` and `values` must have the same shape"
+        
+        # Keep the pixels sorted, so lookups can be done by bisection
+        order = np.argsort(pixels, kind='stable')
+        self.N_SIDE = N_SIDE
+        self.pixels = pixels[order]
+        self.values = values[order]
+    
+    @classmethod
+    def from_full(cls, hpx, mask):
+        """
+        Creates a partial map from a full RING ordered HEALPix array and a
+        boolean (or 0/1 valued) mask, which is non-zero for observed pixels.
+        """
+        pixels = np.flatnonzero(np.asarray(mask) > 0.5)
+        return cls(hp.npix2nside(len(hpx)), pixels, np.asarray(hpx)[pixels])
+    
+    @property
+    def npix(self):
+        return hp.nside2npix(self.N_SIDE)
+    
+    @property
+    def fsky(self):
+        """Observed fraction of the sky."""
+        return self.pixels.size / self.npix
+    
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes + self.values.nbytes
+    
+    def __len__(self):
+        return self.npix
+    
+    def __getitem__(self, pix):
+        """
+        Looks up the values of arbitrary pixels. Unobserved pixels are
+        returned as `hp.UNSEEN`, just like the masked pixels of a full map.
+        """
+        pix = np.asarray(pix)
+        if self.pixels.size == 0:
+            res = np.full(pix.shape, hp.UNSEEN)
+        else:
+            idx = np.searchsorted(self.pixels, pix.ravel())
+            idx[idx == self.pixels.size] = 0
+            seen = self.pixels[idx] == pix.ravel()
+            res = np.where(seen, self.values[idx], hp.UNSEEN).reshape(pix.shape)
+        return res[()] if pix.ndim == 0 else res
+    
+    def to_full(self, fill=hp.UNSEEN, dtype=np.float64):
+        """
+        Expands the partial map into a full HEALPix array, where unobserved
+        pixels are set to `fill`.
+        """
+        hpx = np.full(self.npix, fill, dtype=dtype)
+        hpx[self.pixels] = self.values
+        return hpx
+
+
+def load_partial_HPX(file, mask, field=1, muK=True):
+    """
+    Loads only the unmasked pixels of a HEALPix array from a given field of
+    an input FITS file. The table is memory mapped, hence only the pages of
+    the file that contain observed pixels are read in.
+    
+    Parameters
+    ----------
+    file : str
+        The input `.fits` file.
+    mask : str or numpy.ndarray of shape (12 * N_SIDE**2, )
+        RING ordered mask, which is non-zero for the observed pixels. If a
+        path is given, the mask is read from the first field of that file.
+    field : int
+        Index of the table column (counted from 0) to load.
+    muK : bool
+        If `True`, the values are converted from Kelvin to micro Kelvin.
+    
+    Returns
+    -------
+    phpx : PartialHPX
+        The observed pixels of the map.
+    header : astropy.io.fits.header.Header
+        The header file of the input `.fits` table.
+    """
+    if isinstance(mask, str):
+        mask = hp.read_map(mask, field=0, dtype=np.float32)
+    pixels = np.flatnonzero(np.asarray(mask) > 0.5)
+    
+    with fits.open(file, memmap=True) as hdul:
+        header = hdul[1].header
+        col = hdul[1].data.field(field)
+        N_SIDE = hp.npix2nside(col.size)
+        
+        # Planck maps are usually stored in NESTED ordering
+        rows = pixels
+        if header.get('ORDERING', 'RING').strip().upper() == 'NESTED':
+            rows = hp.ring2nest(N_SIDE, pixels)
+        # Tables may store the map in rows of fixed length (e.g. `1024E`)
+        if col.ndim == 2:
+            values = col[rows // col.shape[1], rows % col.shape[1]]
+        else:
+            values = col[rows]
+        values = np.array(values, dtype=np.float32)
+    
+    if muK:
+        values *= 1e06
+    
+    return PartialHPX(N_SIDE, pixels, values), header
+
+
 ##########################################
 ##    II. Visualize of CMB maps
 ##########################################
 
-def get_projection(hpx, proj='moll', N_SIDE=2048):
+def get_projection(hpx, proj='moll', N_SIDE=2048, xsize=None):
     """
     Projects the input HEALPix dataset on an arbitrary geographical projection,
     which is implemented in the `healpy` package.
     
     Parameters
     ----------
-    hpx : numpy.ndarray in the size of (12 * N_SIDE**2, )
+    hpx : numpy.ndarray in the size of (12 * N_SIDE**2, ) or PartialHPX
         Raw HEALPix dataset, loaded by the `healpy` library from an
         input file (from the `.fits` table in case of Planck's datasets).
-        Stored as Kelvin values in case of Planck.
+        Stored as Kelvin values in case of Planck. Partial maps are
+        projected without expanding them to a full map. If a `HPXPyramid`
+        is given, the coarsest level resolving `xsize` is projected.
     proj : str
         The projection used to create a 2D matrix from the input HEALPix data. Can be
         either of the following:
@@ -88,6 +225,8 @@ def get_projection(hpx, proj='moll', N_SIDE=2048):
         The number of pixels per side in a HEALPix projection. This is always
         determined by the input dataset. In the case of the files of the Planck
         telescope, this value is always N_SIDE = 2048.
+    xsize : int
+        Width of the projected image in pixels. Defaults to `N_SIDE`.
     
     Returns
     -------
@@ -107,12 +246,127 @@ def get_projection(hpx, proj='moll', N_SIDE=2048):
     elif proj == 'orth':
         p = hp.projector.OrthographicProj
     
-    p = p(xsize=N_SIDE, coord='G')
+    xsize = N_SIDE if xsize is None else xsize
+    if isinstance(hpx, HPXPyramid):
+        N_SIDE = hpx.nside_for_xsize(xsize)
+        hpx = hpx.levels[N_SIDE]
+    
+    p = p(xsize=xsize, coord='G')
     hpx_proj = p.projmap(hpx, vec2pix_func=partial(hp.vec2pix, N_SIDE))
     
     return hpx_proj
 
 
+class HPXPyramid:
+    """
+    Multi-resolution pyramid of a HEALPix map, which contains the map
+    degraded by `hp.ud_grade` to every power of 2 resolution between its
+    native :math:`N_{side}` and `min_nside` (e.g. 2048, 1024, ..., 64).
+    Previews and low-:math:`l` analysis can then be done on the coarsest
+    level, which still resolves the requested image size or bandlimit.
+    
+    Parameters
+    ----------
+    hpx : numpy.ndarray in the size of (12 * N_SIDE**2, )
+        The input RING ordered HEALPix map at its native resolution.
+    min_nside : int
+        The :math:`N_{side}` of the coarsest level in the pyramid.
+    """
+    def __init__(self, hpx, min_nside=64):
+        self.levels = {hp.npix2nside(len(hpx)) : hpx}
+        N_SIDE = max(self.levels)
+        while N_SIDE > min_nside:
+            # Every level is degraded from the previous one, which is
+            # equivalent, but cheaper than degrading the native map
+            self.levels[N_SIDE // 2] = hp.ud_grade(self.levels[N_SIDE], N_SIDE // 2)
+            N_SIDE //= 2
+    
+    @staticmethod
+    def signature(hpx, source=None):
+        """
+        Identifies the native map of a pyramid: the modification time and
+        size of its `source` file if given, otherwise the SHA-1 hash of the
+        map itself.
+        """
+        if source is not None:
+            st = os.stat(source)
+            return f'{st.st_mtime_ns}:{st.st_size}'
+        import hashlib
+        return hashlib.sha1(np.ascontiguousarray(hpx).view(np.uint8)).hexdigest()
+    
+    @classmethod
+    def load(cls, path, hpx):
+        """
+        Loads the degraded levels saved by `save`, without recomputing them.
+        The native map `hpx` is not stored in the file, so it has to be given.
+        """
+        pyr = cls.__new__(cls)
+        with np.load(path) as npz:
+            pyr.levels = {int(k.split('_')[1]) : npz[k] for k in npz.files
+                          if k.startswith('nside_')}
+        pyr.levels[hp.npix2nside(len(hpx))] = hpx
+        return pyr
+    
+    @classmethod
+    def cached(cls, hpx, path, min_nside=64, source=None):
+        """
+        Loads the pyramid of `hpx` from `path` if it exists and was built from
+        the same map, otherwise builds it and saves it there, e.g. as
+        `{map}.pyramid.npz` next to the map. The map is identified by the
+        modification time and size of the file `source` it was read from, or
+        by its hash if `source` is `None`.
+        """
+        sig = cls.signature(hpx, source)
+        N_SIDE = hp.npix2nside(len(hpx))
+        if os.path.exists(path):
+            with np.load(path) as npz:
+                valid = (str(npz['signature']) == sig and int(npz['nside']) == N_SIDE
+                         and int(npz['min_nside']) == min_nside)
+            if valid:
+                return cls.load(path, hpx)
+        pyr = cls(hpx, min_nside=min_nside)
+        pyr.save(path, signature=sig, min_nside=min_nside)
+        return pyr
+    
+    def save(self, path, signature='', min_nside=None):
+        """
+        Saves the degraded levels of the pyramid into a single `.npz` file,
+        together with the `signature` of the native map. The native level
+        itself is not saved, as it is already stored in the map file.
+        """
+        N_SIDE = max(self.levels)
+        if min_nside is None:
+            min_nside = min(self.levels)
+        # A unique temporary name, so concurrent saves never share a partial file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix=os.path.basename(path) + '.', suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, signature=np.array(signature), nside=N_SIDE, min_nside=min_nside,
+                     **{f'nside_{n}' : m for n, m in self.levels.items() if n != N_SIDE})
+        os.replace(tmp, path)
+    
+    def nside_for_xsize(self, xsize):
+        """
+        Returns the coarsest :math:`N_{side}`, which pixel size is still not
+        larger than the size of a pixel on an image of width `xsize`,
+        spanning :math:`360^{\circ}` horizontally.
+        """
+        for N_SIDE in sorted(self.levels):
+            if hp.nside2resol(N_SIDE) <= 2 * np.pi / xsize:
+                return N_SIDE
+        return max(self.levels)
+    
+    def nside_for_lmax(self, lmax):
+        """
+        Returns the coarsest :math:`N_{side}` for which the bandlimit
+        satisfies :math:`l_{\mathrm{max}} \leq 2 N_{side}`.
+        """
+        for N_SIDE in sorted(self.levels):
+            if lmax <= 2 * N_SIDE:
+                return N_SIDE
+        return max(self.levels)
+
+
 def planck_cmap():
     """
     Generates the Planck CMB colormap from an input file, which stores
@@ -159,6 +413,8 @@ def plot_cmb(proj, cmap=None, c_min=None, c_max=None,
     save_filename : str
         The name of the saved image file. Only has effect if `save` is
         set to `True`.
+    
+    See `save_cmb_png` for a much faster renderer for quick-look images.
     """
     fig, ax = plt.subplots(figsize=(2*16, 16), dpi=120, facecolor='black',
                            subplot_kw={'facecolor' : 'black'})
@@ -204,6 +460,95 @@ def plot_cmb(proj, cmap=None, c_min=None, c_max=None,
     plt.show()
 
 
+@lru_cache(maxsize=1)
+def planck_lut():
+    """
+    Loads the Planck CMB colormap (see `planck_cmap`) as a lookup table of
+    256 `uint8` RGB colors, which is used by the direct renderer.
+    """
+    cpath = os.path.join(data, 'Planck_Parchment_RGB.txt')
+    lut = np.loadtxt(cpath).astype(np.uint8)
+    lut.setflags(write=False)
+    
+    return lut
+
+
+def render_cmb(proj, c_min=-300, c_max=300, lut=None):
+    """
+    Renders a projected map directly into an RGB image buffer through a
+    colormap lookup table, without creating a `matplotlib` figure. Values
+    are clipped to [`c_min`, `c_max`] and non-finite pixels (e.g. the area
+    outside the projection) are colored black, like in `plot_cmb`.
+    
+    Parameters
+    ----------
+    proj : numpy.ndarray of size (N,M)
+        The input image, created by a `healpy.projector` routine.
+    c_min : float
+        The value mapped to the first color of the lookup table.
+    c_max : float
+        The value mapped to the last color of the lookup table.
+    lut : numpy.ndarray of shape (K, 3)
+        `uint8` RGB lookup table. Defaults to the Planck CMB colormap.
+    
+    Returns
+    -------
+    rgb : numpy.ndarray of shape (N, M, 3)
+        The rendered `uint8` image, with its first row on the top (thus
+        flipped compared to `imshow(..., origin='lower')`).
+    """
+    lut = planck_lut() if lut is None else lut
+    proj = proj[::-1]
+    
+    # Map the values to LUT indices in place, in a single float32 buffer
+    idx = np.subtract(proj, c_min, dtype=np.float32)
+    idx *= (len(lut) - 1) / (c_max - c_min)
+    bad = ~np.isfinite(idx)
+    idx[bad] = 0
+    np.clip(idx, 0, len(lut) - 1, out=idx)
+    
+    rgb = lut[idx.astype(np.intp)]
+    rgb[bad] = 0
+    
+    return rgb
+
+
+def save_cmb_png(proj, save_filename, c_min=-300, c_max=300, lut=None):
+    """
+    Renders a projected map with `render_cmb` and writes it into the output
+    folder as a PNG file, with one image pixel per projection pixel.
+    """
+    os.makedirs(out, exist_ok=True)
+    mpimg.imsave(os.path.join(out, save_filename), render_cmb(proj, c_min, c_max, lut),
+                 format='png')
+
+
+def save_cmb_png_batch(projs, save_filenames, c_min=-300, c_max=300,
+                       lut=None, n_workers=None):
+    """
+    Renders and saves many projected maps in a thread pool. Intended for
+    quick-look images of large simulation sets, while `plot_cmb` should be
+    used for publication quality figures.
+    
+    Parameters
+    ----------
+    projs : iterable of numpy.ndarray
+        The projected maps to render.
+    save_filenames : iterable of str
+        Names of the output PNG files, one for every projection.
+    c_min, c_max, lut
+        See `render_cmb`.
+    n_workers : int
+        Number of threads. Defaults to the `concurrent.futures` default.
+    """
+    lut = planck_lut() if lut is None else lut
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        jobs = [pool.submit(save_cmb_png, p, f, c_min, c_max, lut)
+                for p, f in zip(projs, save_filenames)]
+        for job in jobs:
+            job.result()
+
+
 ##########################################
 ##    III. CMB angular power spectrum
 ##########################################
@@ -216,9 +561,16 @@ def cmb_spectrum(hpx, lmax=2500, alm=True):
     
     Parameters
     ----------
-    hpx : numpy.ndarray in the size of (12 * N_SIDE**2, )
+    hpx : numpy.ndarray in the size of (12 * N_SIDE**2, ) or PartialHPX
         The input raw HEALPix dataset, loaded by the `healpy` library from an
         input file (from the `.fits` table in case of Planck's datasets).
+        Partial maps are expanded with zeros in the unobserved pixels, thus
+        the result is the pseudo-:math:`C_{l}` of the masked sky. If a
+        `HPXPyramid` is given, the coarsest level resolving `lmax` is used,
+        and the spectrum and coefficients are corrected for the extra pixel
+        window of the degraded level (the ratio of `hp.pixwin` of the level
+        and of the native resolution), treating the `hp.ud_grade` averaging
+        as an additional pixel window.
     lmax : int
         Bandlimit of the angular power spectrum. The spectrum and coefficients will
         be calculated up to the spherical harmonic order :math:`l_{\mathrm{max}}`.
@@ -236,13 +588,29 @@ def cmb_spectrum(hpx, lmax=2500, alm=True):
         Spherical harmonics coefficients in the expansion of the
         :math:`\Delta T (\theta, \varphi)` function.
     """
+    window = None
+    if isinstance(hpx, HPXPyramid):
+        N_SIDE = hpx.nside_for_lmax(lmax)
+        if N_SIDE != max(hpx.levels):
+            # Pixel window of the degraded level relative to the native map
+            window = (hp.pixwin(N_SIDE, lmax=lmax)
+                      / hp.pixwin(max(hpx.levels), lmax=lmax))
+        hpx = hpx.levels[N_SIDE]
+    if isinstance(hpx, PartialHPX):
+        hpx = hpx.to_full(fill=0.)
+    
     ell = np.arange(lmax + 1)
     if alm:
         Cl, alm = hp.anafast(hpx, lmax=lmax, alm=True)
+        if window is not None:
+            Cl = Cl / window**2
+            alm = hp.almxfl(alm, 1 / window)
         Dl = ell * (ell + 1) / (2 * np.pi) * Cl
         return ell[2:], Cl[2:], Dl[2:], alm[2:]
     else:
         Cl = hp.anafast(hpx, lmax=lmax, alm=False)
+        if window is not None:
+            Cl = Cl / window**2
         Dl = ell * (ell + 1) / (2 * np.pi) * Cl
         return ell[2:], Cl[2:], Dl[2:]
 
@@ -1,12 +1,16 @@
 import os
 import sys
+import tempfile
 import numpy as np
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import seaborn as sns
 import matplotlib as mpl
 import matplotlib.cm as cm
 import matplotlib.mlab as mlab
 import matplotlib.pyplot as plt
+import matplotlib.image as mpimg
 from matplotlib.colors import LogNorm
 from matplotlib.colors import ListedColormap
 from mpl_toolkits.axes_grid1 import make_axes_locatable
@@ -23,6 +27,97 @@ axislegendsize = 23
 axistextsize = 20
 axiscbarfontsize = 15
 
+_SPECTRUM_LAYOUTS = {
+    'scalcls' : ['TT', 'EE', 'TE', 'PP', 'TP'],
+    'totalcls' : ['TT', 'EE', 'BB', 'TE'],
+    'lensedcls' : ['TT', 'EE', 'BB', 'TE'],
+}
+_spectrum_cache = {}
+
+def _spectrum_signature(fname, use_hash=False):
+    """Modification time and size, or SHA-1 hash of a file."""
+    if use_hash:
+        import hashlib
+        with open(fname, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    st = os.stat(fname)
+    return '{0}:{1}'.format(st.st_mtime_ns, st.st_size)
+
+def load_spectrum(fname, usecols=None, lmax=None, columns=None, layout=None,
+                  use_hash=False, write_sidecar=True):
+    """
+    Loads the columns of a spectrum file (e.g. `CAMB_fiducial_cosmo_scalCls.dat`)
+    with the same result as `np.loadtxt(fname, usecols=usecols, unpack=True)`.
+    The text file is parsed only once per session, and stored in a binary
+    `.npz` sidecar (`{fname}.npz`) next to it, which is used by later sessions.
+    Both are rebuilt automatically whenever the modification time and size (or
+    the SHA-1 hash) of the text file change.
+    
+    Parameters
+    ----------
+    fname : str
+        Path to the spectrum file. The first column should contain the
+        multipoles :math:`\ell`.
+    usecols : tuple of int
+        Columns to return. If `None`, all columns are returned.
+    lmax : int
+        Bandlimit of the returned spectra. If `None`, every multipole
+        in the file is returned.
+    columns : list of str
+        Names of the spectra to return after the multipoles, e.g. 'TT', 'EE',
+        'BB', 'TE' or 'PP', instead of `usecols`.
+    layout : list of str
+        Names of the columns following the multipoles in the file. If `None`,
+        it is guessed from the filename (CAMB `scalCls` or `totalCls`/`lensedCls`),
+        and a single TT column is assumed for unknown names.
+    use_hash : bool
+        If `True`, the cached table is validated by the SHA-1 hash of the file
+        instead of its modification time and size.
+    write_sidecar : bool
+        If `False`, the parsed table is only cached in memory.
+    
+    Returns
+    -------
+    cols : numpy.ndarray of shape (len(usecols), N_ell)
+        The requested columns, up to :math:`\ell_{\mathrm{max}}`. With
+        `columns` given, the first row is :math:`\ell`.
+    """
+    sig = _spectrum_signature(fname, use_hash)
+    sidecar = fname + '.npz'
+    
+    table = None
+    if fname in _spectrum_cache and _spectrum_cache[fname][0] == sig:
+        table = _spectrum_cache[fname][1]
+    elif os.path.exists(sidecar):
+        with np.load(sidecar) as npz:
+            if str(npz['signature']) == sig:
+                table = npz['table']
+    if table is None:
+        table = np.loadtxt(fname, ndmin=2)
+        if write_sidecar:
+            # A unique temporary name, so concurrent loads never share a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(sidecar) or '.',
+                                       prefix=os.path.basename(sidecar) + '.', suffix='.part')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, table=table, signature=np.array(sig))
+            os.replace(tmp, sidecar)
+    _spectrum_cache[fname] = (sig, table)
+    
+    if columns is not None:
+        if layout is None:
+            name = os.path.basename(fname).lower()
+            layout = next((l for k, l in _SPECTRUM_LAYOUTS.items() if k in name), ['TT'])
+        for c in columns:
+            assert c in layout, "No column `{0}` in `{1}` (layout {2})".format(c, fname, layout)
+        usecols = [0] + [1 + layout.index(c) for c in columns]
+    
+    if lmax is not None:
+        table = table[:np.searchsorted(table[:, 0], lmax, side='right')]
+    cols = table.T if usecols is None else table.T[list(usecols)]
+    
+    return cols
+  ###############################
+
 def haversine(X, Y):
     """
     Calculates the Haversine formula for every gridpoint on a given domain.
@@ -276,6 +371,61 @@ def plot_CMB_map(CMB_I, X_width, Y_width,
     plt.show()
   ###############################
 
+@lru_cache(maxsize=1)
+def planck_lut():
+    """
+    Loads the Planck CMB colormap as a lookup table of 256 `uint8` RGB colors,
+    which is used by `render_CMB_maps`. The file is read only once.
+    """
+    lut = np.loadtxt(data + 'Planck_Parchment_RGB.txt').astype(np.uint8)
+    lut.setflags(write=False)
+    
+    return lut
+
+def render_CMB_maps(maps, save_filenames,
+                    c_min=-400, c_max=400, n_workers=None):
+    """
+    Renders rectangular CMB maps straight into PNG files through the Planck CMB
+    colormap lookup table, without creating `matplotlib` figures. Maps are rendered
+    in a thread pool, one pixel per map pixel. Non-finite pixels (e.g. masked ones)
+    are colored black. Meant for quick-look images of large simulation sets, while
+    `plot_CMB_map` should be used for publication figures.
+    
+    Parameters
+    ----------
+    maps : iterable of numpy.ndarray of shape (N_x, N_y)
+        The maps to render.
+    save_filenames : iterable of str
+        Names of the PNG files in the output folder, one for every map.
+    c_min : float
+        The value mapped to the first color of the colormap.
+    c_max : float
+        The value mapped to the last color of the colormap.
+    n_workers : int
+        Number of threads. Defaults to the `concurrent.futures` default.
+    """
+    lut = planck_lut()
+    scale = (len(lut) - 1) / (c_max - c_min)
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    def _render(Map, save_filename):
+        # Same orientation as `imshow(..., origin='lower')`
+        idx = np.subtract(Map[::-1], c_min, dtype=np.float32)
+        idx *= scale
+        bad = ~np.isfinite(idx)
+        idx[bad] = 0
+        np.clip(idx, 0, len(lut) - 1, out=idx)
+        rgb = lut[idx.astype(np.intp)]
+        rgb[bad] = 0
+        mpimg.imsave(out + save_filename, rgb, format='png')
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        jobs = [pool.submit(_render, m, f) for m, f in zip(maps, save_filenames)]
+        for job in jobs:
+            job.result()
+  ###############################
+
 def plot_CMB_steps(ell2d, ClTT2d, CMB_2D,
                    X_width, Y_width,
                    no_axis=False, no_grid=True):
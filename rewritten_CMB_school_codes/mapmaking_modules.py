@@ -0,0 +1,1127 @@
+import os
+import json
+import shutil
+import numpy as np
+from functools import partial
+
+## Routines of the Part 9 mapmaking notebook, collected here so they can be
+## shared by the different mapmakers.
+
+def sim_pointing(map, dir=0):
+    """
+    Simulate a telescope scanning across the given map. The scanning pattern is
+    as simple as possible: The samples hit the center of each pixel, and we
+    scan rowwise (dir=0) or columnwise (dir=1).
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The map to scan. Only its shape is used.
+    dir : int
+        Scan direction, 0 for left-right and 1 for up-down scans.
+
+    Returns
+    -------
+    point : numpy.ndarray of shape (2, N_y * N_x)
+        The [{y,x},nsamp] pixel position of every sample.
+    """
+    # The pointing is an [{y,x},nsamp] array of pixel positions
+    # The einsum stuff is just to swap the second and third axis
+    # of pixmap, which contains the pixel coordinates of each pixel.
+    pixmap = np.mgrid[:map.shape[-2],:map.shape[-1]]  ## makes two arrays of the x and y indices in the map
+    pixmap[1,1::2, :] = pixmap[1,1::2, ::-1]          ## reverse ever other row so the scans go back and forth
+    if dir == 0: point = pixmap.reshape(2,-1)         ## arranges these for L-R scans
+    else:        point = np.roll(pixmap,1,axis=0).reshape(2,-1)   ## arranges these for U-D scans
+    return point
+
+def scan_pix(shape, dir=0, start=0, nsamp=None):
+    """
+    Flattened pixel indices of the samples `start..start+nsamp` of the
+    `sim_pointing` scan, without building the full pixel grid. Scans longer
+    than the map repeat the pattern.
+
+    Parameters
+    ----------
+    shape : tuple of int
+        Shape of the map. Columnwise scans need a square map, as in
+        `sim_pointing`.
+    dir : int
+        Scan direction, 0 for left-right and 1 for up-down scans.
+    start : int
+        Index of the first sample.
+    nsamp : int
+        Number of samples. Defaults to the rest of a single pass over the map.
+
+    Returns
+    -------
+    pix : numpy.ndarray of shape (nsamp, )
+        The `int32` flattened pixel index of every sample.
+    """
+    ny, nx = shape[-2:]
+    if nsamp is None: nsamp = ny*nx - start
+    k = (start + np.arange(nsamp)) % (ny*nx)
+    row, col = np.divmod(k, nx)
+    col = np.where(row % 2 == 1, nx-1-col, col)   ## reverse every other row
+    if dir == 0: return (row*nx + col).astype(np.int32)
+    assert ny == nx, "columnwise scans need a square map"
+    return (col*nx + row).astype(np.int32)
+
+class Pointing:
+    """
+    Compact pointing of a single scan. The rounded, flattened pixel index of
+    every sample and the hit count map are computed once, so the pointing
+    matrix P and its transpose become a single gather and a single bincount.
+
+    Parameters
+    ----------
+    point : numpy.ndarray of shape (2, nsamp)
+        The [{y,x},nsamp] pixel position of every sample, e.g. from
+        `sim_pointing`.
+    shape : tuple of int
+        Shape of the map.
+    """
+    def __init__(self, point, shape):
+        self.shape = tuple(shape[-2:])
+        self.npix  = self.shape[0]*self.shape[1]
+        point = np.round(point).astype(int)
+        self.pix  = np.ravel_multi_index(point, self.shape).astype(np.int32)
+        self.hits = np.bincount(self.pix, minlength=self.npix).reshape(self.shape)
+    @classmethod
+    def from_pix(cls, pix, shape, chunk=2**20):
+        """
+        Pointing from already flattened pixel indices, e.g. a memory-mapped
+        `int32` array of a `TODStore`. The hits are counted in chunks of `chunk`
+        samples.
+        """
+        self = cls.__new__(cls)
+        self.shape = tuple(shape[-2:])
+        self.npix  = self.shape[0]*self.shape[1]
+        self.pix   = pix
+        self.hits  = np.zeros(self.npix, dtype=int)
+        for i in range(0, pix.size, chunk):
+            self.hits += np.bincount(pix[i:i+chunk], minlength=self.npix)
+        self.hits  = self.hits.reshape(self.shape)
+        return self
+    @property
+    def nsamp(self): return self.pix.size
+    def observe(self, map):
+        """P: project map to tod"""
+        return np.take(map.reshape(-1), self.pix)
+    def transpose(self, tod):
+        """P': project tod to map"""
+        return np.bincount(self.pix, tod, minlength=self.npix).reshape(self.shape)
+
+def Observe_map(map, point):
+    """
+    Pointing matrix: Project map to tod.
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The map to observe.
+    point : Pointing or numpy.ndarray of shape (2, nsamp)
+        The pointing of the scan.
+
+    Returns
+    -------
+    tod : numpy.ndarray of shape (nsamp, )
+        The value of the map at every sample.
+    """
+    if isinstance(point, Pointing): return point.observe(map)
+    point = np.round(point).astype(int)
+    return map[point[0],point[1]]  ## return the value of the map at each pointing, this forms the simulated time stream
+
+def PT(tod, point, shape):
+    """
+    Transpose pointing matrix: Project tod to map.
+
+    Parameters
+    ----------
+    tod : numpy.ndarray of shape (nsamp, )
+        The time stream.
+    point : Pointing or numpy.ndarray of shape (2, nsamp)
+        The pointing of the scan.
+    shape : tuple of int
+        Shape of the map.
+
+    Returns
+    -------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The sum of the samples falling into every pixel.
+    """
+    if isinstance(point, Pointing): return point.transpose(tod)
+    point = np.round(point).astype(int)
+    point_flat = np.ravel_multi_index(point, shape[-2:])
+    map = np.bincount(point_flat, tod, minlength=shape[-2]*shape[-1])
+    map = map.reshape(shape[-2:])
+    return map
+
+def sim_noise_spec(nsamp, dt=.00416, fknee=0.1, alpha=3, sigma=40):
+    """
+    Build a simple atmosphere + white noise model, and return it
+    as a power spectrum.
+
+    Parameters
+    ----------
+    nsamp : int
+        Number of samples of the tod.
+    dt : float
+        Sampling period in seconds.
+    fknee : float
+        Knee frequency of the :math:`1/f` atmosphere in Hz.
+    alpha : float
+        Spectral index of the atmosphere.
+    sigma : float
+        White noise level per sample in :math:`\\mu K`.
+
+    Returns
+    -------
+    noise_spec : numpy.ndarray of shape (nsamp, )
+        The noise power, in the frequency order of `np.fft.fft`.
+    """
+    freq   = np.abs(np.fft.fftfreq(nsamp, dt))
+    return (1+(np.maximum(freq,freq[1])/fknee)**-alpha)*sigma**2
+
+def sim_tod(map, point, noise_spec):
+    """
+    Simulate a noisy TOD using the model d = Pm + n.
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The sky map.
+    point : Pointing or numpy.ndarray of shape (2, nsamp)
+        The pointing of the scan.
+    noise_spec : numpy.ndarray of shape (nsamp, )
+        Power spectrum of the noise.
+
+    Returns
+    -------
+    tod : numpy.ndarray of shape (nsamp, )
+    """
+    tod    = Observe_map(map, point)
+    rand   = np.fft.fft(np.random.standard_normal(tod.shape[-1]))
+    fnoise = rand * noise_spec**0.5
+    tod   += np.fft.ifft(fnoise).real
+    return tod
+
+class Data:
+    """
+    A single scan: its tod, pointing and noise spectrum.
+    """
+    def __init__(self, tod, point, noise_spec):
+        self.tod   = tod
+        self.point = point
+        self.noise_spec = noise_spec
+        self._inv_noise = None
+    @property
+    def inv_noise(self):
+        """Cached InvNoise operator of this scan."""
+        if self._inv_noise is None or self._inv_noise.noise_spec is not self.noise_spec:
+            self._inv_noise = InvNoise(self.noise_spec)
+        return self._inv_noise
+
+def sim_dataset(map, num_data=2, dt=.00416, fknee=0.1, alpha=3, sigma=40):
+    """
+    Simulate a dataset consisting of `num_data` scans across the sky, with
+    alternating left-right and up-down scans. The pointing is stored as a
+    `Pointing` object with precomputed pixel indices and hits. The other
+    keyword arguments are passed to `sim_noise_spec`.
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The sky map.
+    num_data : int
+        Number of scans.
+
+    Returns
+    -------
+    dataset : list of Data
+        The tod, the pointing and the noise spectrum of every scan.
+    """
+    res = []
+    for i in range(num_data):
+        point = Pointing(sim_pointing(map, i % 2), map.shape)
+        noise_spec = sim_noise_spec(point.nsamp, dt=dt, fknee=fknee, alpha=alpha, sigma=sigma)
+        tod = sim_tod(map, point, noise_spec)
+        res.append(Data(tod, point, noise_spec))
+    return res
+  ###############################
+
+class StoredData:
+    """
+    A single scan of a `TODStore` with the interface of `Data`. The tod and
+    the pixels are memory-mapped, and the noise spectrum is the model
+    function of the store, so nothing of scan length is held in RAM.
+
+    Parameters
+    ----------
+    store : TODStore
+        The store holding the scan.
+    i : int
+        Index of the scan in the store.
+    """
+    def __init__(self, store, i):
+        self.store = store
+        self.scan  = store.scans[i]
+        o, n = self.scan["offset"], self.scan["nsamp"]
+        self.tod   = store.tod[o:o+n]
+        self.pix   = store.pix[o:o+n]
+        self.noise_spec = store.noise_spec
+        self._point = None
+    @property
+    def point(self):
+        if self._point is None:
+            self._point = Pointing.from_pix(self.pix, self.store.shape)
+        return self._point
+    @property
+    def inv_noise(self):
+        return self.store.inv_noise(self.scan["nsamp"])
+
+class TODStore:
+    """
+    Out-of-core storage of simulated scans. The directory `path` holds
+    `tod.npy` (`float32`) and `pix.npy` (`int32`, flattened pixel index), with
+    all the scans concatenated, and `meta.json` with the map shape, the noise
+    model, and the offset and length of every scan and chunk. The arrays are
+    memory-mapped, so the store can be much larger than the RAM. Iterating
+    over the store yields `StoredData` objects, so it can be passed to the
+    mapmakers in place of a list of `Data`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store, as created by `TODStore.simulate`.
+    mode : str
+        Memory-map mode of the arrays.
+    """
+    def __init__(self, path, mode="r"):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.shape  = tuple(meta["shape"])
+        self.noise  = meta["noise"]
+        self.chunk, self.ntap = meta["chunk"], meta["ntap"]
+        self.scans  = meta["scans"]
+        self.chunks = meta["chunks"]
+        self.tod = np.load(os.path.join(path, "tod.npy"), mmap_mode=mode)
+        self.pix = np.load(os.path.join(path, "pix.npy"), mmap_mode=mode)
+        self.noise_spec = partial(sim_noise_spec, **self.noise)
+        self._inv_noise = {}
+        self._data = {}
+    def __reduce__(self):
+        # Reopen the files instead of pickling the mapped arrays
+        return (TODStore, (self.path,))
+    def __len__(self): return len(self.scans)
+    def __getitem__(self, i):
+        if i not in self._data: self._data[i] = StoredData(self, i)
+        return self._data[i]
+    def __iter__(self):
+        for i in range(len(self)): yield self[i]
+    def inv_noise(self, nsamp):
+        """Chunked InvNoise of the noise model, shared by the scans of equal length."""
+        if nsamp not in self._inv_noise:
+            self._inv_noise[nsamp] = InvNoise(self.noise_spec, chunk=self.chunk, ntap=self.ntap, nsamp=nsamp)
+        return self._inv_noise[nsamp]
+    def iter_chunks(self):
+        """Yield (scan index, tod, pix) of every chunk."""
+        for c in self.chunks:
+            o, n = c["offset"], c["nsamp"]
+            yield c["scan"], self.tod[o:o+n], self.pix[o:o+n]
+    @classmethod
+    def simulate(cls, path, map, scans, chunk=2**16, ntap=2**14, dt=.00416, fknee=0.1, alpha=3, sigma=40,
+                 seed=0, overwrite=False):
+        """
+        Simulate the scans d = Pm + n of a map chunk by chunk into a new store.
+        The noise of every scan is white noise filtered by sqrt(noise_spec) with
+        overlap-save, so the memory use only depends on `chunk` and `ntap`.
+        Fluctuations slower than the `chunk + 2*ntap` samples of the filter grid
+        are not simulated.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the new store.
+        map : numpy.ndarray of shape (N_y, N_x)
+            The sky map.
+        scans : list of tuple
+            A `(dir, nsamp)` pair for every detector scan, with the scan
+            directions of `sim_pointing`.
+        chunk : int
+            Number of samples simulated and filtered at once.
+        ntap : int
+            Half length of the truncated noise filter kernel.
+        dt, fknee, alpha, sigma : float
+            The noise model, see `sim_noise_spec`.
+        seed : int
+            The noise of the i-th scan is seeded with `(seed, i)`.
+        overwrite : bool
+            If `True`, an existing store at `path` is replaced.
+
+        Returns
+        -------
+        store : TODStore
+        """
+        if os.path.exists(path):
+            if not overwrite: raise FileExistsError(path)
+            shutil.rmtree(path)
+        os.makedirs(path)
+        noise  = dict(dt=dt, fknee=fknee, alpha=alpha, sigma=sigma)
+        ntot   = sum(n for _, n in scans)
+        tod    = np.lib.format.open_memmap(os.path.join(path, "tod.npy"), "w+", np.float32, (ntot,))
+        pix    = np.lib.format.open_memmap(os.path.join(path, "pix.npy"), "w+", np.int32, (ntot,))
+        white  = np.lib.format.open_memmap(os.path.join(path, "white.tmp.npy"), "w+", np.float32, (max(n for _, n in scans),))
+        flat   = map.reshape(-1)
+        meta   = {"shape": list(map.shape[-2:]), "noise": noise, "chunk": chunk, "ntap": ntap, "scans": [], "chunks": []}
+        offset = 0
+        for i, (dir, n) in enumerate(scans):
+            meta["scans"].append({"offset": offset, "nsamp": n, "dir": dir, "seed": [seed, i]})
+            rng = np.random.RandomState([seed, i])
+            for s in range(0, n, chunk):
+                m = min(chunk, n-s)
+                white[s:s+m] = rng.standard_normal(m)
+                pix[offset+s:offset+s+m] = scan_pix(map.shape, dir, s, m)
+            filt = NoiseFilter(partial(sim_noise_spec, **noise), 0.5, chunk=chunk, ntap=ntap, nsamp=n)
+            filt(white[:n], out=tod[offset:offset+n])
+            for s in range(0, n, chunk):
+                m = min(chunk, n-s)
+                p = pix[offset+s:offset+s+m]
+                tod[offset+s:offset+s+m] += flat[p]
+                meta["chunks"].append({"scan": i, "offset": offset+s, "nsamp": m,
+                                       "pix_min": int(p.min()), "pix_max": int(p.max())})
+            offset += n
+        tod.flush(); pix.flush()
+        del white
+        os.remove(os.path.join(path, "white.tmp.npy"))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return cls(path)
+  ###############################
+
+def solve_binned_average(dataset, shape):
+    """
+    Solve the simplified mapmaking equation Ax=b,
+    where A = P'P and b = P'd, e.g. ignoring noise
+    properties such as correlations. A `TODStore` is
+    binned chunk by chunk.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+
+    Returns
+    -------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The binned map, NaN in the unhit pixels.
+    """
+    if isinstance(dataset, TODStore):
+        npix = shape[-2]*shape[-1]
+        rhs, hits = np.zeros(npix), np.zeros(npix)
+        for _, tod, pix in dataset.iter_chunks():
+            rhs  += np.bincount(pix, tod, minlength=npix)
+            hits += np.bincount(pix, minlength=npix)
+        return (rhs/hits).reshape(shape)
+    rhs  = np.zeros(shape)
+    hits = np.zeros(shape)
+    for data in dataset:
+        rhs  += PT(data.tod,    data.point, shape)
+        if isinstance(data.point, Pointing): hits += data.point.hits
+        else: hits += PT(data.tod*0+1, data.point, shape)
+    return rhs/hits
+
+def mul_inv_noise(tod, noise_spec):
+    """
+    Multiply by the inverse noise matrix. We assume that the noise
+    is stationary, which means that it can be represented by a simple
+    power spectrum noise_spec. This function is used to apply inverse
+    variance weighting to the data. See `InvNoise` for a faster version.
+    """
+    ftod  = np.fft.fft(tod)
+    ftod /= noise_spec
+    return np.fft.ifft(ftod).real
+
+# numpy >= 2.0 can write the FFTs into preallocated arrays
+_FFT_OUT = np.lib.NumpyVersion(np.__version__) >= "2.0.0"
+def _rfft(x, out):
+    if _FFT_OUT: return np.fft.rfft(x, out=out)
+    out[:] = np.fft.rfft(x)
+    return out
+def _irfft(x, n, out):
+    if _FFT_OUT: return np.fft.irfft(x, n, out=out)
+    out[:] = np.fft.irfft(x, n)
+    return out
+
+class NoiseFilter:
+    """
+    Stationary filter multiplying a TOD by `noise_spec**power` in Fourier
+    space, e.g. `power=-1` for the inverse noise operator N" (see `InvNoise`),
+    or `power=0.5` to turn white noise into noise with the spectrum
+    `noise_spec`. The positive frequency half of `noise_spec**power` is cached,
+    and the TOD is filtered with the real FFT, which halves the work and the
+    temporary memory compared to `mul_inv_noise`. The half spectrum and the
+    result are written into buffers that are allocated once and reused by
+    every call (the FFTs write into them directly with numpy >= 2.0).
+
+    With `chunk` given, the TOD is processed by overlap-save: the circular
+    filter kernel is truncated to +-`ntap` samples, and the TOD is filtered
+    in blocks of `chunk` samples plus `ntap` samples of context on each side.
+    The working memory then scales with `chunk + 2*ntap` instead of the scan
+    length, and the TOD may be a memory-mapped array. `ntap` must cover the
+    correlation length of the filter, a few times `1/(fknee*dt)` samples for
+    the atmosphere model of `sim_noise_spec`.
+
+    Parameters
+    ----------
+    noise_spec : numpy.ndarray of shape (nsamp, ) or callable
+        Power spectrum of the noise, symmetric in frequency (as returned by
+        `sim_noise_spec`). In the chunked mode it may also be a function
+        returning the spectrum for a given number of samples (e.g. a
+        `functools.partial` of `sim_noise_spec`), which is then only evaluated
+        on the chunk grid.
+    power : float
+        Power of the spectrum applied to the TOD.
+    chunk : int
+        Block length of the overlap-save mode. If `None`, the whole TOD is
+        filtered at once.
+    ntap : int
+        Half length of the truncated kernel. Defaults to `chunk`.
+    nsamp : int
+        Length of the TOD. Defaults to `len(noise_spec)`.
+
+    Attributes
+    ----------
+    diag : float
+        The diagonal of the filter matrix.
+    """
+    def __init__(self, noise_spec, power=1, chunk=None, ntap=None, nsamp=None):
+        self.noise_spec = noise_spec
+        self.power = power
+        self.nsamp = len(noise_spec) if nsamp is None else nsamp
+        self.chunk = chunk
+        self._out  = None
+        if chunk is None:
+            spec = np.asarray(noise_spec, dtype=float)**power
+            self.fspec = spec[:self.nsamp//2+1]
+            self.diag  = np.mean(spec)
+            self._ftod = np.empty(self.nsamp//2+1, dtype=complex)
+            return
+        if ntap is None: ntap = chunk
+        self.ntap = min(ntap, (self.nsamp-1)//2)
+        self.nfft = chunk + 2*self.ntap
+        # Truncated kernel with taps -ntap..ntap, placed circularly
+        if callable(noise_spec):
+            kernel = np.fft.irfft(noise_spec(self.nfft)[:self.nfft//2+1]**power, self.nfft)
+        else:
+            kernel = np.fft.irfft(np.asarray(noise_spec[:self.nsamp//2+1], dtype=float)**power, self.nsamp)
+        kbuf = np.zeros(self.nfft)
+        kbuf[:self.ntap+1] = kernel[:self.ntap+1]
+        kbuf[self.nfft-self.ntap:] = kernel[len(kernel)-self.ntap:]
+        self.diag  = kernel[0]
+        self.kspec = np.fft.rfft(kbuf)
+        self._seg  = np.zeros(self.nfft)
+        self._fseg = np.empty(self.nfft//2+1, dtype=complex)
+        self._iseg = np.empty(self.nfft)
+        self._base = np.arange(-self.ntap, self.nfft-self.ntap)
+        self._idx  = np.zeros(self.nfft, dtype=np.int64)
+    def __call__(self, tod, out=None):
+        """
+        Filter a TOD.
+
+        Parameters
+        ----------
+        tod : numpy.ndarray of shape (nsamp, )
+            The TOD, possibly memory-mapped in the chunked mode.
+        out : numpy.ndarray of shape (nsamp, )
+            Output array. If `None`, an internal buffer is used, which is reused
+            (and overwritten) by the next call.
+
+        Returns
+        -------
+        out : numpy.ndarray of shape (nsamp, )
+        """
+        if out is None:
+            if self._out is None or self._out.shape != tod.shape: self._out = np.empty(tod.shape)
+            out = self._out
+        if self.chunk is None:
+            ftod  = _rfft(tod, self._ftod)
+            ftod *= self.fspec
+            if out.dtype == float and out.flags.c_contiguous: _irfft(ftod, self.nsamp, out)
+            else: out[:] = np.fft.irfft(ftod, self.nsamp)
+            return out
+        for i in range(0, self.nsamp, self.chunk):
+            m = min(self.chunk, self.nsamp-i)
+            if tod.dtype == self._seg.dtype: np.take(tod, self._wrap(i), mode="wrap", out=self._seg)
+            else: self._seg[:] = np.take(tod, self._wrap(i), mode="wrap")
+            out[i:i+m] = self._filter_seg(m)
+        return out
+    def _wrap(self, i):
+        """Indices of the block starting at sample i with its context. The
+        wrapped indices keep the periodic boundary of the full FFT"""
+        return np.add(self._base, i, out=self._idx)
+    def _filter_seg(self, m):
+        """Filter the segment buffer, and return its first m valid samples"""
+        fseg  = _rfft(self._seg, self._fseg)
+        fseg *= self.kspec
+        return _irfft(fseg, self.nfft, self._iseg)[self.ntap:self.ntap+m]
+    def project(self, pix, shape, map=None, tod=None):
+        """
+        P' of the filtered TOD, where the TOD is either `tod` or P `map`. In the
+        chunked mode the TOD is built, filtered and binned block by block, so no
+        array of the scan length is made, and `pix` and `tod` may be
+        memory-mapped.
+
+        Parameters
+        ----------
+        pix : numpy.ndarray of shape (nsamp, )
+            The flattened pixel index of every sample.
+        shape : tuple of int
+            Shape of the map.
+        map : numpy.ndarray of shape (N_y, N_x)
+            The map to observe, filter and project back.
+        tod : numpy.ndarray of shape (nsamp, )
+            The TOD to filter and project, if `map` is `None`.
+
+        Returns
+        -------
+        map : numpy.ndarray of shape (N_y, N_x)
+        """
+        npix = shape[-2]*shape[-1]
+        if self.chunk is None:
+            if map is not None: tod = np.take(map.reshape(-1), pix)
+            return np.bincount(pix, self(tod), minlength=npix).reshape(shape[-2:])
+        res = np.zeros(npix)
+        for i in range(0, self.nsamp, self.chunk):
+            m = min(self.chunk, self.nsamp-i)
+            if map is not None: np.take(map.reshape(-1), np.take(pix, self._wrap(i), mode="wrap"), out=self._seg)
+            else: self._seg[:] = np.take(tod, self._wrap(i), mode="wrap")
+            # Bin into the pixel range of the block only
+            p = np.asarray(pix[i:i+m])
+            pmin = p.min()
+            bins = np.bincount(p-pmin, self._filter_seg(m))
+            res[pmin:pmin+bins.size] += bins
+        return res.reshape(shape[-2:])
+
+class InvNoise(NoiseFilter):
+    """
+    Inverse noise operator N" of a stationary noise spectrum `noise_spec`.
+    See `NoiseFilter` for the parameters and the chunked mode.
+    """
+    def __init__(self, noise_spec, chunk=None, ntap=None, nsamp=None):
+        NoiseFilter.__init__(self, noise_spec, -1, chunk=chunk, ntap=ntap, nsamp=nsamp)
+
+def _partial_A(dataset, idx, x, shape):
+    """Contribution P'N"Px of the scans idx of dataset"""
+    res = np.zeros(shape)
+    for i in idx:
+        data = dataset[i]
+        if isinstance(data, StoredData):
+            # Streamed block by block, without tods of the scan length
+            res += data.inv_noise.project(data.pix, shape, map=x)
+            continue
+        tod  = Observe_map(x, data.point)
+        tod  = data.inv_noise(tod)
+        res += PT(tod, data.point, shape)
+    return res
+
+def _partial_b(dataset, idx, shape):
+    """Contribution P'N"d of the scans idx of dataset"""
+    res = np.zeros(shape)
+    for i in idx:
+        data = dataset[i]
+        if isinstance(data, StoredData): res += data.inv_noise.project(data.pix, shape, tod=data.tod)
+        else: res += PT(data.inv_noise(data.tod), data.point, shape)
+    return res
+
+def full_system(dataset, shape):
+    """
+    Build the operator A = P'N"P and the right-hand side b = P'N"d of
+    the full map-making equation.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+
+    Returns
+    -------
+    A : callable
+        The operator, acting on flattened maps.
+    b : numpy.ndarray of shape (N_y * N_x, )
+        The flattened right-hand side.
+    """
+    # Set up our A matrix. We don't compute
+    # explicitly because it's too big. Instead,
+    # we define it as a function that can be applied
+    # to a vector x. We will then use Conjugate Gradients
+    # to invert it.
+    idx = range(len(dataset))
+    def A(x):
+        # x is 1d because the conjugate gradient solver works
+        # on 1d arrays. So start by expanding it to 2d.
+        return _partial_A(dataset, idx, x.reshape(shape), shape).reshape(-1)
+    # Build our right-hand side b
+    b = _partial_b(dataset, idx, shape)
+    return A, b.reshape(-1)
+
+_worker_dataset = None
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+def _worker_A(args):
+    idx, x, shape = args
+    return _partial_A(_worker_dataset, idx, x, shape)
+def _worker_b(args):
+    idx, shape = args
+    return _partial_b(_worker_dataset, idx, shape)
+
+class ParallelSystem:
+    """
+    The full map-making system A = P'N"P, b = P'N"d of `full_system`,
+    evaluated in a pool of workers. The scans are split between the workers
+    once, every worker accumulates the contribution of its own scans into a
+    partial map, and the partial maps are summed at the end. Use it as a
+    context manager, or call `close()`.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+    n_workers : int
+        Number of workers. Defaults to the number of CPUs.
+    processes : bool
+        If `True`, the dataset is sent to every worker process once, when the
+        pool starts (a `TODStore` is reopened from its path), and only the maps
+        travel afterwards. If `False`, a thread pool is used, which avoids the
+        copies, but only scales as far as numpy releases the GIL.
+    """
+    def __init__(self, dataset, shape, n_workers=None, processes=True):
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        self.shape     = tuple(shape)
+        self.n_workers = n_workers or os.cpu_count()
+        # Round robin split, balanced if the scans have similar lengths
+        self.parts = [list(range(i, len(dataset), self.n_workers)) for i in range(min(self.n_workers, len(dataset)))]
+        if processes:
+            self.pool = ProcessPoolExecutor(self.n_workers, initializer=_init_worker, initargs=(dataset,))
+            self._map_A = lambda x: self.pool.map(_worker_A, [(idx, x, self.shape) for idx in self.parts])
+            self._map_b = lambda:   self.pool.map(_worker_b, [(idx, self.shape) for idx in self.parts])
+        else:
+            # Each thread gets its own store, so no filter buffers are shared
+            views = [TODStore(dataset.path) if isinstance(dataset, TODStore) else dataset for _ in self.parts]
+            self.pool = ThreadPoolExecutor(self.n_workers)
+            self._map_A = lambda x: self.pool.map(_partial_A, views, self.parts, [x]*len(views), [self.shape]*len(views))
+            self._map_b = lambda:   self.pool.map(_partial_b, views, self.parts, [self.shape]*len(views))
+    def A(self, x):
+        return sum(self._map_A(x.reshape(self.shape))).reshape(-1)
+    def b(self):
+        return sum(self._map_b()).reshape(-1)
+    def close(self): self.pool.shutdown()
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+def benchmark_parallel(map, n_workers=(1, 2, 4), num_data=8, napply=10, processes=True, seed=0, **kwargs):
+    """
+    Measure the wall time of `napply` applications of A = P'N"P with
+    `ParallelSystem` for every number of workers, on `num_data` simulated
+    scans of a map. Extra keyword arguments are passed to `sim_dataset`.
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N_y, N_x)
+        The sky map.
+    n_workers : tuple of int
+        The numbers of workers to measure.
+    num_data : int
+        Number of scans.
+    napply : int
+        Number of applications of A in every measurement.
+    processes : bool
+        Whether to use processes or threads, see `ParallelSystem`.
+    seed : int
+        Seed of the simulation.
+
+    Returns
+    -------
+    res : dict
+        `{n_workers: (time, speedup)}`, with the speedup relative to the
+        serial `full_system` operator, which is stored under the key 0.
+    """
+    import time
+    np.random.seed(seed)
+    dataset = sim_dataset(map, num_data=num_data, **kwargs)
+    x = np.random.standard_normal(map.size)
+    A, _ = full_system(dataset, map.shape)
+    A(x)
+    t0 = time.perf_counter()
+    for i in range(napply): ref = A(x)
+    serial = time.perf_counter()-t0
+    res = {0: (serial, 1.)}
+    for n in n_workers:
+        with ParallelSystem(dataset, map.shape, n, processes=processes) as system:
+            assert np.allclose(system.A(x), ref)
+            t0 = time.perf_counter()
+            for i in range(napply): system.A(x)
+            dt = time.perf_counter()-t0
+            res[n] = (dt, serial/dt)
+    return res
+
+def jacobi_preconditioner(dataset, shape):
+    """
+    Inverse of the diagonal of A = P'N"P. The diagonal of the stationary
+    (circulant) N" is the mean of the inverse noise spectrum, so the diagonal
+    of A is the hit map weighted by mean(1/noise_spec) of every scan, which
+    is cached as `data.inv_noise.diag`.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+
+    Returns
+    -------
+    M : callable
+        The preconditioner, acting on flattened maps. Unhit pixels are set to
+        zero.
+    """
+    diag = np.zeros(shape)
+    for data in dataset:
+        hits  = data.point.hits if isinstance(data.point, Pointing) else PT(data.tod*0+1, data.point, shape)
+        diag += hits * data.inv_noise.diag
+    idiag = np.zeros(diag.size)
+    idiag[diag.reshape(-1) > 0] = 1/diag.reshape(-1)[diag.reshape(-1) > 0]
+    def M(x): return x*idiag
+    return M
+
+def solve_full(dataset, shape, niter=100, verbose=True, tol=None, precond=None, x0=None, return_cg=False,
+               n_workers=None, processes=True, system=None):
+    """
+    Solve the full map-making equation
+    Ax=b, where A = P'N"P and b = P'N"d.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+    niter : int
+        Maximal number of CG iterations.
+    verbose : bool
+        If `True`, the error and the residual of every iteration is printed.
+    tol : float
+        If given, the iteration stops as soon as the relative residual
+        |b-Ax|/|b| drops below `tol`.
+    precond : str or callable
+        `None`, "jacobi" (inverse hits-weighted diagonal of A) or a function
+        acting on flattened maps.
+    x0 : str or numpy.ndarray of shape (N_y, N_x)
+        `None`, "binned" (start from the `solve_binned_average` map) or a
+        starting map.
+    return_cg : bool
+        If `True`, the CG object is returned too, whose `.i` and `.resid` tell
+        how far it got.
+    n_workers : int
+        If given, the system is evaluated by a `ParallelSystem` of this many
+        workers.
+    processes : bool
+        Whether the `ParallelSystem` uses processes or threads.
+    system : ParallelSystem
+        An already running `ParallelSystem` to use.
+
+    Returns
+    -------
+    map : numpy.ndarray of shape (N_y, N_x)
+    cg : CG
+        Only if `return_cg` is `True`.
+    """
+    if n_workers is not None:
+        with ParallelSystem(dataset, shape, n_workers, processes=processes) as system:
+            return solve_full(dataset, shape, niter=niter, verbose=verbose, tol=tol, precond=precond,
+                              x0=x0, return_cg=return_cg, system=system)
+    if system is None: A, b = full_system(dataset, shape)
+    else:              A, b = system.A, system.b()
+    if   precond is None:     M = default_M
+    elif precond == "jacobi": M = jacobi_preconditioner(dataset, shape)
+    else:                     M = precond
+    if isinstance(x0, str) and x0 == "binned":
+        x0 = solve_binned_average(dataset, shape)
+        x0[~np.isfinite(x0)] = 0
+    if x0 is not None: x0 = np.asarray(x0, dtype=float).reshape(-1)
+    # And solve
+    bnorm = np.sqrt(default_dot(b, b))
+    cg = CG(A, b, x0=x0, M=M)
+    cg.resid = np.sqrt(default_dot(cg.r, cg.r))/bnorm
+    while cg.i < niter and not (tol is not None and cg.resid < tol):
+        cg.step()
+        cg.resid = np.sqrt(default_dot(cg.r, cg.r))/bnorm
+        if verbose: print("iteration: %4d conjugate gradient error: %15.7e residual: %15.7e" % (cg.i, cg.err, cg.resid))
+    if return_cg: return cg.x.reshape(shape), cg
+    return cg.x.reshape(shape)
+
+def benchmark_solvers(map, tol=1e-6, niter=1000, num_data=2, seed=0, **kwargs):
+    """
+    Compare the unpreconditioned, the Jacobi preconditioned, and the
+    Jacobi preconditioned CG started from the binned map on a simulated
+    left-right/up-down dataset of a square map. Extra keyword arguments are
+    passed to `sim_dataset`.
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N, N)
+        The sky map.
+    tol : float
+        The relative residual to reach.
+    niter : int
+        Maximal number of CG iterations.
+    num_data : int
+        Number of scans.
+    seed : int
+        Seed of the simulation.
+
+    Returns
+    -------
+    res : dict
+        The number of iterations, the wall time, the reached residual and the
+        rms difference to the input map, for every setup.
+    """
+    import time
+    np.random.seed(seed)
+    dataset = sim_dataset(map, num_data=num_data, **kwargs)
+    setups  = {"plain": (None, None), "jacobi": ("jacobi", None), "jacobi+binned": ("jacobi", "binned")}
+    res = {}
+    for name, (precond, x0) in setups.items():
+        t0 = time.time()
+        x, cg = solve_full(dataset, map.shape, niter=niter, verbose=False, tol=tol,
+                           precond=precond, x0=x0, return_cg=True)
+        res[name] = {"iterations": cg.i, "time": time.time()-t0, "residual": cg.resid,
+                     "map_rms": np.std(x-map)}
+    return res
+
+class DestripeSystem:
+    """
+    The destriping equation (F'ZF)a = F'Zd. The noise of every scan is
+    modelled as a baseline offset that is constant over segments of
+    `baseline_length` samples, plus white noise of equal variance in all the
+    scans. F is the baseline matrix, spreading the offsets a over their
+    segments, and Z = 1-P(P'P)"P' removes from a tod everything that is
+    constant on the sky. A works on the baselines of all the scans,
+    concatenated. Offsets that are constant over every segment are not
+    constrained by the data, as they are degenerate with the map mean.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+    baseline_length : int
+        Number of samples per baseline.
+    """
+    def __init__(self, dataset, shape, baseline_length=100):
+        self.dataset = dataset
+        self.shape   = tuple(shape[-2:])
+        self.baseline_length = baseline_length
+        hits = np.zeros(self.shape)
+        for data in dataset:
+            hits += data.point.hits if isinstance(data.point, Pointing) else PT(data.tod*0+1, data.point, self.shape)
+        self.ihits = np.zeros(self.shape)
+        self.ihits[hits > 0] = 1/hits[hits > 0]
+        # Segment of every sample, and offset of every scan in the baselines
+        self.segs = [np.arange(data.tod.size)//baseline_length for data in dataset]
+        self.nseg = [seg[-1]+1 for seg in self.segs]
+        self.offsets = np.concatenate([[0], np.cumsum(self.nseg)])
+        self.counts  = np.concatenate([np.bincount(seg) for seg in self.segs]).astype(float)
+    @property
+    def nbase(self): return self.offsets[-1]
+    def bin(self, tods):
+        """(P'P)"P': the binned map of one tod per scan"""
+        map = np.zeros(self.shape)
+        for data, tod in zip(self.dataset, tods):
+            map += PT(tod, data.point, self.shape)
+        return map*self.ihits
+    def baselines(self, a):
+        """F: the baseline tods of every scan"""
+        return [a[o:o+n][seg] for o, n, seg in zip(self.offsets, self.nseg, self.segs)]
+    def project(self, tods):
+        """F'Z: the baseline sums of the tods after removing the binned map"""
+        map = self.bin(tods)
+        res = np.empty(self.nbase)
+        for data, tod, o, n, seg in zip(self.dataset, tods, self.offsets, self.nseg, self.segs):
+            res[o:o+n] = np.bincount(seg, tod - Observe_map(map, data.point), minlength=n)
+        return res
+    def A(self, a): return self.project(self.baselines(a))
+    def b(self): return self.project([data.tod for data in self.dataset])
+    def M(self, a):
+        """Inverse of the number of samples per baseline, the diagonal of F'F"""
+        return a/self.counts
+    def map(self, a):
+        """Binned map of the tod after subtracting the baselines a"""
+        return self.bin([data.tod - base for data, base in zip(self.dataset, self.baselines(a))])
+
+def solve_destriped(dataset, shape, baseline_length=100, niter=100, verbose=True, tol=None, return_cg=False):
+    """
+    Destriping mapmaker: solve the `DestripeSystem` for the baseline offsets
+    with the preconditioned CG, and return the binned map of the destriped
+    tod. The free overall offset is fixed by making the baselines average to
+    zero over the samples, so the map has the mean of the
+    `solve_binned_average` map. The cost of an iteration is a P and a P'
+    without any FFT, and the number of unknowns is the number of baselines
+    instead of the number of pixels.
+
+    Parameters
+    ----------
+    dataset : list of Data or TODStore
+        The scans.
+    shape : tuple of int
+        Shape of the map.
+    baseline_length : int
+        Number of samples per baseline.
+    niter, verbose, tol, return_cg
+        As in `solve_full`, with the residual measured on the baseline
+        equation.
+
+    Returns
+    -------
+    map : numpy.ndarray of shape (N_y, N_x)
+    cg : CG
+        Only if `return_cg` is `True`.
+    """
+    system = DestripeSystem(dataset, shape, baseline_length)
+    b = system.b()
+    bnorm = np.sqrt(default_dot(b, b))
+    cg = CG(system.A, b, M=system.M)
+    cg.resid = np.sqrt(default_dot(cg.r, cg.r))/bnorm
+    while cg.i < niter and not (tol is not None and cg.resid < tol):
+        cg.step()
+        cg.resid = np.sqrt(default_dot(cg.r, cg.r))/bnorm
+        if verbose: print("iteration: %4d conjugate gradient error: %15.7e residual: %15.7e" % (cg.i, cg.err, cg.resid))
+    a = cg.x - np.sum(cg.x*system.counts)/np.sum(system.counts)
+    map = system.map(a)
+    if return_cg: return map, cg
+    return map
+
+def benchmark_destriper(map, baseline_lengths=(25, 100, 400), tol=1e-6, niter=1000, num_data=2, seed=0, **kwargs):
+    """
+    Compare the destriper to `solve_binned_average` and to the Jacobi
+    preconditioned `solve_full` started from the binned map, on a simulated
+    left-right/up-down dataset of a square map. Extra keyword arguments are
+    passed to `sim_dataset`. With the row/column scans of `sim_pointing`,
+    baselines shorter than a row leave offsets that are constant on square
+    blocks of the map unconstrained, so the baselines should span at least a
+    row.
+
+    Parameters
+    ----------
+    map : numpy.ndarray of shape (N, N)
+        The sky map.
+    baseline_lengths : tuple of int
+        The baseline lengths of the destriper to measure.
+    tol : float
+        The relative residual to reach.
+    niter : int
+        Maximal number of CG iterations.
+    num_data : int
+        Number of scans.
+    seed : int
+        Seed of the simulation.
+
+    Returns
+    -------
+    res : dict
+        The wall time, the number of CG iterations, the relative residual it
+        stopped at, and the rms difference to the input map (after removing
+        the mean, which the destriper does not measure), for every mapmaker.
+    """
+    import time
+    np.random.seed(seed)
+    dataset = sim_dataset(map, num_data=num_data, **kwargs)
+    res = {}
+    t0 = time.time()
+    x  = solve_binned_average(dataset, map.shape)
+    res["binned"] = {"iterations": 0, "time": time.time()-t0, "residual": np.nan, "map_rms": np.std(x-map)}
+    t0 = time.time()
+    x, cg = solve_full(dataset, map.shape, niter=niter, verbose=False, tol=tol,
+                       precond="jacobi", x0="binned", return_cg=True)
+    res["full"] = {"iterations": cg.i, "time": time.time()-t0, "residual": cg.resid, "map_rms": np.std(x-map)}
+    for L in baseline_lengths:
+        t0 = time.time()
+        x, cg = solve_destriped(dataset, map.shape, L, niter=niter, verbose=False, tol=tol, return_cg=True)
+        res["destripe %d" % L] = {"iterations": cg.i, "time": time.time()-t0, "residual": cg.resid,
+                                  "map_rms": np.std(x-map)}
+    return res
+
+def default_M(x):     return np.copy(x)
+def default_dot(a,b): return a.dot(np.conj(b))
+class CG:
+    """
+    A simple Preconditioned Conjugate gradients solver. Solves
+    the equation system Ax=b.
+
+    Parameters
+    ----------
+    A : callable
+        The operator, acting on vectors and returning vectors.
+    b : numpy.ndarray
+        The right-hand side.
+    x0 : numpy.ndarray
+        Starting guess, 0 if not provided.
+    M : callable
+        The preconditioner, acting on vectors and returning vectors.
+    dot : callable
+        The dot product. This is useful for MPI-parallelization, for example.
+    """
+    def __init__(self, A, b, x0=None, M=default_M, dot=default_dot):
+        """Initialize a solver for the system Ax=b, with a starting guess of x0 (0
+        if not provided). Vectors b and x0 must provide addition and multiplication,
+        as well as the .copy() method, such as provided by numpy arrays. The
+        preconditioner is given by M. A and M must be functors acting on vectors
+        and returning vectors. The dot product may be manually specified using the
+        dot argument. This is useful for MPI-parallelization, for example."""
+        # Init parameters
+        self.A   = A
+        self.b   = b
+        self.M   = M
+        self.dot = dot
+        if x0 is None:
+            self.x = b*0
+            self.r = b
+        else:
+            self.x   = x0.copy()
+            self.r   = b-self.A(self.x)
+        # Internal work variables
+        n = b.size
+        self.z   = self.M(self.r)
+        self.rz  = self.dot(self.r, self.z)
+        self.rz0 = float(self.rz)
+        self.p   = self.z
+        self.err = np.inf
+        self.d   = 4
+        self.arz = []
+        self.i   = 0
+    def step(self):
+        """Take a single step in the iteration. Results in .x, .i
+        and .err being updated. To solve the system, call step() in
+        a loop until you are satisfied with the accuracy. The result
+        can then be read off from .x."""
+        Ap = self.A(self.p)
+        alpha = self.rz/self.dot(self.p, Ap)
+        self.x += alpha*self.p
+        self.r -= alpha*Ap
+        self.z = self.M(self.r)
+        next_rz = self.dot(self.r, self.z)
+        self.err = next_rz/self.rz0
+        beta = next_rz/self.rz
+        self.rz = next_rz
+        self.p = self.z + beta*self.p
+        self.arz.append(self.rz*alpha)
+        self.i += 1
+  ###############################
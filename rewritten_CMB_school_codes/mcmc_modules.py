@@ -0,0 +1,815 @@
+import os
+import json
+import time
+import numpy as np
+
+data = './data/'
+out = './output/'
+
+# Order of the cosmological parameters in the parameter vectors and chains
+param_names = ['H0', 'ombh2', 'omch2', 'omk', 'tau', 'ns']
+
+class S4TTLikelihood:
+    """
+    Fake likelihood of the CMB S4 TT data, based on realistic high-:math:`\ell`
+    noise. The :math:`\ell` to bin index array and the inverse variances of the
+    bins are computed only once, so a call is a single gather and a weighted
+    sum of squares, which is vectorized over a whole batch of model spectra.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the file of binned errors. Its columns are the bin centers
+        in :math:`\ell`, the binned :math:`D_{\ell}` values and their errors.
+    bin_data : numpy.ndarray of shape (3, N_bins)
+        The already loaded binned errors. If given, `fname` is ignored.
+    """
+    def __init__(self, fname=data + 'binned_errors.dat', bin_data=None):
+        if bin_data is None:
+            bin_data = np.loadtxt(fname, unpack=True)
+        self.ell_bins = bin_data[0]
+        self.Dl_data = bin_data[1]
+        self.idx = np.array(bin_data[0] - 0.5, dtype='int')
+        self.inv_var = 1 / bin_data[2]**2
+        self.lmin = self.idx.max() + 1   # Minimal length of the model spectra
+
+    def residuals(self, model):
+        """
+        Returns the differences of the binned model and data spectra, with
+        shape `(..., N_bins)` for models of shape `(..., lmax)`.
+        """
+        model = np.asarray(model)
+        assert model.shape[-1] >= self.lmin, f"Model spectra should have at least {self.lmin} multipoles"
+        return model[..., self.idx] - self.Dl_data
+
+    def __call__(self, model):
+        """
+        Evaluates the log-likelihood of one or many model spectra.
+
+        Parameters
+        ----------
+        model : numpy.ndarray of shape (lmax, ) or (n_models, lmax)
+            The model :math:`D_{\ell}^{TT}` spectra, in :math:`\mu K^{2}`,
+            indexed by :math:`\ell` starting from :math:`\ell = 0`.
+
+        Returns
+        -------
+        loglike : float or numpy.ndarray of shape (n_models, )
+            Log-likelihood of the model spectra.
+        """
+        res = self.residuals(model)
+        return -0.5 * np.einsum('...i,...i,i->...', res, res, self.inv_var)
+
+    def gradient(self, model):
+        """
+        Gradient of the log-likelihood with respect to the model spectra.
+
+        Returns
+        -------
+        grad : numpy.ndarray of the same shape as `model`
+            Derivatives of the log-likelihood by every :math:`D_{\ell}` of the
+            model. It is zero for the multipoles not contained in any bin.
+        """
+        model = np.asarray(model)
+        grad = np.zeros(model.shape, dtype=np.float64)
+        grad[..., self.idx] = -self.residuals(model) * self.inv_var
+        return grad
+  ###############################
+
+class SpectrumLogLike:
+    """
+    Log-likelihood of a parameter vector, which combines a spectrum provider
+    (e.g. `spectrum_modules.SpectrumProvider`) and a likelihood of spectra
+    (e.g. `S4TTLikelihood`). Objects are picklable if both components are,
+    thus they can be shipped to the worker processes of `run_chains`.
+    """
+    def __init__(self, provider, likelihood):
+        self.provider = provider
+        self.likelihood = likelihood
+
+    def __call__(self, params):
+        return self.likelihood(self.provider(params))
+
+def mcmc_mh(ratln, rng=np.random):
+    """
+    Metropolis–Hastings acceptance test of a step with log-likelihood ratio
+    `ratln`. If the step is definitely better, it is always accepted, otherwise
+    it is accepted with probability `exp(ratln)`.
+    """
+    return np.exp(ratln) > rng.rand()
+
+class GaussianProposal:
+    """
+    Fixed, diagonal Gaussian proposal of the Metropolis–Hastings sampler.
+
+    Parameters
+    ----------
+    stepvec : numpy.array of shape (N_params, )
+        Standard deviations of the steps along every parameter.
+    """
+    def __init__(self, stepvec):
+        self.stepvec = np.asarray(stepvec, dtype=np.float64)
+
+    def propose(self, x, rng):
+        return x + rng.randn(len(x)) * self.stepvec
+
+    def update(self, x):
+        pass
+
+class AdaptiveProposal:
+    """
+    Adaptive Metropolis proposal (Haario, Saksman & Tamminen 2001), which
+    learns the proposal covariance from the running chain. Until `adapt_start`
+    steps are seen, the fixed diagonal `stepvec` is used, then steps are drawn
+    from :math:`\mathcal{N}(0, s_{d} (C + \epsilon I))`, where :math:`C` is the
+    running covariance of the chain and :math:`s_{d} = 2.38^{2} / d`. Parameters
+    with zero step size (e.g. `omk` in Part 8) are kept fixed.
+
+    Parameters
+    ----------
+    stepvec : numpy.array of shape (N_params, )
+        Standard deviations of the initial, diagonal proposal.
+    adapt_start : int
+        Number of seen states after which the learned covariance is used.
+    update_every : int
+        The Cholesky factor of the proposal is recomputed only this often.
+    eps : float
+        Relative regularization of the learned covariance.
+    """
+    def __init__(self, stepvec, adapt_start=200, update_every=50, eps=1e-6):
+        self.stepvec = np.asarray(stepvec, dtype=np.float64)
+        self.free = self.stepvec > 0
+        self.adapt_start = adapt_start
+        self.update_every = update_every
+        self.eps = eps
+        self.scale = 2.38**2 / self.free.sum()
+
+        d = self.free.sum()
+        self.n = 0
+        self.mean = np.zeros(d)
+        self.M2 = np.zeros((d, d))
+        self.chol = None
+
+    @classmethod
+    def from_chain(cls, fname, stepvec, burn=0, **kwargs):
+        """
+        Creates a proposal warm started from the steps of an existing chain
+        file (e.g. `data/chain.csv`), skipping the first `burn` steps.
+        """
+        return cls(stepvec, **kwargs).warm_start(fname, burn=burn)
+
+    def warm_start(self, fname, burn=0):
+        """
+        Replaces the learned state of the proposal by the running covariance
+        of the steps of a chain file, skipping the first `burn` steps.
+        Returns the proposal itself.
+        """
+        steps = _read_chain(fname, burn=burn)[:, :-1]
+        if len(steps) > 0:
+            x = steps[:, self.free]
+            self.n = len(x)
+            self.mean = x.mean(axis=0)
+            self.M2 = (x - self.mean).T @ (x - self.mean)
+            self._factorize()
+        return self
+
+    @property
+    def cov(self):
+        """The running covariance of the free parameters."""
+        return self.M2 / max(self.n - 1, 1)
+
+    def _factorize(self):
+        if self.n < self.adapt_start:
+            return
+        cov = self.cov
+        reg = self.eps * np.diag(np.maximum(np.diag(cov), self.stepvec[self.free]**2))
+        try:
+            self.chol = np.linalg.cholesky(self.scale * (cov + reg))
+        except np.linalg.LinAlgError:
+            # Keep the previous factor if the covariance is not yet positive definite
+            pass
+
+    def update(self, x):
+        # Welford's online update of the mean and the scatter matrix
+        x = np.asarray(x)[self.free]
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.M2 += np.outer(delta, x - self.mean)
+        if self.n % self.update_every == 0:
+            self._factorize()
+
+    def propose(self, x, rng):
+        if self.chol is None:
+            return x + rng.randn(len(x)) * self.stepvec
+        new = np.array(x, dtype=np.float64)
+        new[self.free] += self.chol @ rng.randn(self.free.sum())
+        return new
+  ###############################
+
+def integrated_autocorr_time(x, c=5):
+    """
+    Estimates the integrated autocorrelation time of a chain with an FFT
+    based autocorrelation function and the automatic windowing of Sokal,
+    which truncates the sum at the smallest lag :math:`M \geq c \tau(M)`.
+
+    Parameters
+    ----------
+    x : numpy.ndarray of shape (N_steps, ) or (N_steps, N_params)
+        The chain of a single or many parameters.
+
+    Returns
+    -------
+    tau : float or numpy.array of shape (N_params, )
+        The integrated autocorrelation time(s) in steps.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    single = x.ndim == 1
+    x = x.reshape(len(x), -1)
+    n = len(x)
+
+    f = np.fft.rfft(x - x.mean(axis=0), n=2*n, axis=0)
+    acf = np.fft.irfft(f * np.conj(f), axis=0)[:n]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf /= acf[0]
+    acf[:, ~np.isfinite(acf[0])] = 0
+    acf[0] = 1      # Constant (e.g. fixed) parameters are uncorrelated
+
+    taus = 2 * np.cumsum(acf, axis=0) - 1
+    window = np.arange(n)[:, None] >= c * taus
+    M = np.where(window.any(axis=0), window.argmax(axis=0), n - 1)
+    tau = np.maximum(taus[M, np.arange(x.shape[1])], 1.)
+
+    return tau[0] if single else tau
+
+def _read_chain(fname, burn=0):
+    """
+    Reads the rows of a CSV or a binary (`.chain`) chain file after the first
+    `burn` steps, as an array of shape (N_steps, N_params + 1).
+    """
+    if fname.endswith(ChainStore.ext):
+        return ChainStore(fname).select(burn=burn)
+    return np.genfromtxt(fname, delimiter=',', skip_header=1 + burn, ndmin=2)
+
+def sampling_report(fname, wall_time, burn=0):
+    """
+    Summarizes the efficiency of a chain file written by `run_chain`.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the CSV or binary (`.chain`) chain file.
+    wall_time : float
+        Wall-clock time of the sampling in seconds.
+    burn : int
+        Number of initial steps to discard.
+
+    Returns
+    -------
+    report : dict
+        The acceptance rate, the integrated autocorrelation times and the
+        effective sample sizes (ESS) of the parameters, the smallest ESS per
+        wall-clock second and per likelihood evaluation (one per step).
+    """
+    chain = _read_chain(fname, burn=burn)
+    steps = chain[:, :-1]
+    free = np.ptp(steps, axis=0) > 0
+
+    moved = np.any(steps[1:] != steps[:-1], axis=1)
+    tau = integrated_autocorr_time(steps[:, free]) if free.any() else np.array([])
+    ess = len(steps) / tau
+
+    return {
+        'steps' : len(steps),
+        'acceptance_rate' : moved.mean() if len(moved) > 0 else np.nan,
+        'tau' : tau,
+        'ess' : ess,
+        'ess_per_second' : ess.min() / wall_time if len(ess) > 0 else 0.,
+        'ess_per_evaluation' : ess.min() / len(steps) if len(ess) > 0 else 0.,
+    }
+  ###############################
+
+class ChainStore:
+    """
+    Append-only binary chain file with a fixed record dtype, which can be
+    memory mapped. The file starts with a small JSON header (padded to 64
+    bytes) containing the column names (e.g. `H0, ombh2, omch2, omk, tau,
+    ns, loglike`) and the dtype, followed by the raw rows. A partially
+    written last row (after a crash) is ignored, and overwritten on append.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the chain file, conventionally with a `.chain` extension.
+    names : list of str
+        Column names. Required only when a new file is created.
+    dtype : str
+        Data type of the columns.
+    overwrite : bool
+        If `True`, an existing file is replaced by an empty one.
+    """
+    ext = '.chain'
+    _MAGIC = b'#CHAIN '
+
+    def __init__(self, fname, names=None, dtype='<f8', overwrite=False):
+        self.fname = fname
+        self._f = None
+        if overwrite or not os.path.exists(fname):
+            assert names is not None, "`names` are required to create a new chain file"
+            header = {'names' : list(names), 'dtype' : np.dtype(dtype).str}
+            line = self._MAGIC + json.dumps(header).encode()
+            line += b' ' * (-(len(line) + 1) % 64) + b'\n'
+            with open(fname, 'wb') as f:
+                f.write(line)
+
+        with open(fname, 'rb') as f:
+            line = f.readline()
+        assert line.startswith(self._MAGIC), f"`{fname}` is not a chain file"
+        header = json.loads(line[len(self._MAGIC):])
+        self.names = header['names']
+        self.offset = len(line)
+        self.dtype = np.dtype([(n, header['dtype']) for n in self.names])
+
+    def __len__(self):
+        return (os.path.getsize(self.fname) - self.offset) // self.dtype.itemsize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def append(self, rows, fsync=False):
+        """
+        Appends one row, or an array of rows of shape (N_rows, N_columns)
+        to the end of the file.
+        """
+        if self._f is None:
+            self._f = open(self.fname, 'rb+')
+        # Cut a partial last row, left behind by an interrupted write
+        self._f.seek(self.offset + len(self) * self.dtype.itemsize)
+        self._f.truncate()
+        rows = np.asarray(rows, dtype=self.dtype[0]).reshape(-1, len(self.names))
+        self._f.write(rows.tobytes())
+        self._f.flush()
+        if fsync:
+            os.fsync(self._f.fileno())
+
+    def records(self):
+        """Read-only memory map of the rows, with the columns as named fields."""
+        return np.memmap(self.fname, dtype=self.dtype, mode='r',
+                         offset=self.offset, shape=(len(self),))
+
+    def array(self):
+        """Read-only memory map of the rows as a 2D array of shape (N_rows, N_columns)."""
+        return np.memmap(self.fname, dtype=self.dtype[0], mode='r',
+                         offset=self.offset, shape=(len(self), len(self.names)))
+
+    def select(self, burn=0, thin=1, columns=None):
+        """
+        Selects the steps after a burn-in period, keeping every `thin`-th step
+        and the given columns (all by default). Only the selected rows are
+        read from the disk.
+
+        Returns
+        -------
+        steps : numpy.ndarray of shape (N_selected, N_columns)
+        """
+        idx = slice(None) if columns is None else [self.names.index(c) for c in columns]
+        return np.array(self.array()[burn::thin][:, idx])
+
+    @classmethod
+    def from_csv(cls, csv_fname, fname, chunksize=100000):
+        """
+        Converts a CSV chain file (e.g. `data/chain.csv`) into a binary chain
+        file, reading it in chunks of `chunksize` rows.
+        """
+        with open(csv_fname) as f:
+            names = f.readline().strip().split(',')
+            with cls(fname, names=names, overwrite=True) as store:
+                while True:
+                    lines = [l for _, l in zip(range(chunksize), f)]
+                    if len(lines) == 0:
+                        break
+                    store.append(np.loadtxt(lines, delimiter=',', ndmin=2))
+        return cls(fname)
+
+    def to_csv(self, csv_fname, burn=0, thin=1, chunksize=100000):
+        """
+        Exports the (optionally burned-in and thinned) chain into the CSV
+        layout of `data/chain.csv`, writing it in chunks of `chunksize` rows.
+        """
+        steps = self.array()[burn::thin]
+        with open(csv_fname, 'w') as f:
+            f.write(','.join(self.names) + '\n')
+            for i in range(0, len(steps), chunksize):
+                np.savetxt(f, steps[i:i+chunksize], delimiter=',', fmt='%.17g')
+  ###############################
+
+def _truncate_partial_row(fname):
+    """
+    Removes an incomplete last line of a chain file, which is left behind if
+    the sampler was killed while writing it.
+    """
+    with open(fname, 'rb+') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # Find the last complete line from the end of the file
+        pos = size - 1
+        while pos > 0:
+            step = min(4096, pos)
+            f.seek(pos - step)
+            block = f.read(step)
+            nl = block.rfind(b'\n')
+            if nl >= 0:
+                f.truncate(pos - step + nl + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+def read_chain_state(fname):
+    """
+    Returns the number of written steps of a chain file, and its last state
+    as the parameter vector and log-likelihood, or `(0, None, None)` if the
+    chain is empty. Only the last rows are read for the state.
+    """
+    if not os.path.exists(fname):
+        return 0, None, None
+    if fname.endswith(ChainStore.ext):
+        store = ChainStore(fname)
+        if len(store) == 0:
+            return 0, None, None
+        last = store.array()[-1]
+        return len(store), last[:-1].copy(), last[-1]
+    _truncate_partial_row(fname)
+
+    with open(fname, 'rb') as f:
+        n_rows = sum(block.count(b'\n') for block in iter(lambda: f.read(1 << 20), b''))
+        n_steps = max(n_rows - 1, 0)   # The first row is the header
+        if n_steps == 0:
+            return 0, None, None
+        f.seek(max(f.tell() - 4096, 0))
+        last = f.read().splitlines()[-1]
+
+    row = np.array(last.decode().split(','), dtype=np.float64)
+    return n_steps, row[:-1], row[-1]
+
+def run_chain(loglike_fn, params, proposal, steps, fname,
+              seed=None, resume=True, fsync=False,
+              stop_file=None, check_every=100):
+    """
+    Runs a single Metropolis–Hastings chain and appends every step to a
+    CSV file as soon as it is made, in the layout of `data/chain.csv`
+    (`H0, ombh2, omch2, omk, tau, ns, loglike`). A crashed run loses at
+    most the step in progress, and is continued from the last written
+    state if the routine is called again with `resume=True`. If `fname`
+    ends with `.chain`, the steps are written into a binary `ChainStore`.
+
+    Parameters
+    ----------
+    loglike_fn : callable
+        Returns the log-likelihood of a parameter vector.
+    params : numpy.array of shape (N_params, )
+        Starting parameter vector of the chain.
+    proposal : object
+        Proposal with `propose(x, rng)` and `update(x)` methods, e.g.
+        `GaussianProposal`. On resume, an `AdaptiveProposal` that has not
+        seen any steps yet is warm started from the steps in the file.
+    steps : int
+        Total number of steps in the chain, including the resumed ones.
+    fname : str
+        Path to the chain file.
+    seed : int
+        Seed of the random number generator of the chain. On resume, it is
+        combined with the number of already written steps.
+    resume : bool
+        If `False`, an existing chain file is overwritten.
+    fsync : bool
+        If `True`, every step is synced to the disk, not only flushed.
+    stop_file : str
+        If a file exists under this path, the chain is stopped early. It is
+        created e.g. by `ChainMonitor` when the chains converged.
+    check_every : int
+        The `stop_file` is checked only once in this many steps.
+
+    Returns
+    -------
+    n_steps : int
+        Number of steps in the chain file.
+    accepted : int
+        Number of accepted steps during this call.
+    """
+    n_done, step, LL = read_chain_state(fname) if resume else (0, None, None)
+    if n_done > 0 and isinstance(proposal, AdaptiveProposal) and proposal.n == 0:
+        # Rebuild the adaptive state of a fresh proposal from the written steps
+        proposal.warm_start(fname)
+    rng = np.random.RandomState(None if seed is None else [seed, n_done])
+    names = param_names if len(params) == len(param_names) else [f'p{i}' for i in range(len(params))]
+
+    accepted = 0
+    if fname.endswith(ChainStore.ext):
+        f = ChainStore(fname, names=names + ['loglike'], overwrite=(n_done == 0))
+    else:
+        f = open(fname, 'a' if n_done > 0 else 'w')
+    with f:
+        def write(x, ll):
+            if isinstance(f, ChainStore):
+                f.append(np.append(x, ll), fsync=fsync)
+                return
+            f.write(','.join(repr(float(v)) for v in x) + ',' + repr(float(ll)) + '\n')
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+
+        if n_done == 0:
+            if not isinstance(f, ChainStore):
+                f.write(','.join(names + ['loglike']) + '\n')
+            # Always accept the first, initializing step
+            step = np.asarray(params, dtype=np.float64)
+            LL = loglike_fn(step)
+            write(step, LL)
+            n_done = 1
+
+        for i in range(n_done, steps):
+            if stop_file is not None and i % check_every == 0 and os.path.exists(stop_file):
+                return i, accepted
+            new = proposal.propose(step, rng)
+            new_LL = loglike_fn(new)
+            if mcmc_mh(new_LL - LL, rng):
+                step, LL = new, new_LL
+                accepted += 1
+            proposal.update(step)
+            write(step, LL)
+
+    return max(n_done, steps), accepted
+
+def _run_chain_job(args):
+    return run_chain(*args)
+
+def run_chains(loglike_fn, params, proposal, steps, fnames,
+               seeds=None, n_workers=None, resume=True,
+               monitor=None, poll=5.):
+    """
+    Runs several independent Metropolis–Hastings chains in parallel worker
+    processes, each streaming its steps into its own file with `run_chain`.
+
+    Parameters
+    ----------
+    loglike_fn : callable
+        Picklable log-likelihood of a parameter vector, e.g. `SpectrumLogLike`.
+    params : numpy.ndarray of shape (N_params, ) or (N_chains, N_params)
+        Starting parameter vectors, common or one per chain.
+    proposal : object
+        Picklable proposal, copied into every chain.
+    steps : int
+        Number of steps in every chain.
+    fnames : list of str
+        Paths to the chain files, one per chain.
+    seeds : list of int
+        Seeds of the chains. Defaults to `0, 1, ..., N_chains - 1`.
+    n_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    resume : bool
+        If `True`, existing chain files are continued.
+    monitor : ChainMonitor
+        If given, it is updated from the chain files every `poll` seconds,
+        and the chains are stopped as soon as it reports convergence.
+    poll : float
+        Time between two updates of the `monitor` in seconds.
+
+    Returns
+    -------
+    results : list of tuples
+        The `(n_steps, accepted)` pairs returned by `run_chain` for every chain.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    params = np.asarray(params, dtype=np.float64)
+    params = np.broadcast_to(params, (len(fnames), params.shape[-1]))
+    seeds = range(len(fnames)) if seeds is None else seeds
+    # A stale stop file would end the resumed chains immediately
+    stop_file = fnames[0] + '.stop'
+    if os.path.exists(stop_file):
+        os.remove(stop_file)
+    jobs = [(loglike_fn, p, proposal, steps, fname, seed, resume, False, stop_file)
+            for p, fname, seed in zip(params, fnames, seeds)]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_run_chain_job, job) for job in jobs]
+        while monitor is not None and not all(f.done() for f in futures):
+            time.sleep(poll)
+            monitor.update()
+            if monitor.converged():
+                open(stop_file, 'w').close()
+                break
+        results = [f.result() for f in futures]
+
+    if os.path.exists(stop_file):
+        os.remove(stop_file)
+    return results
+  ###############################
+
+class ChainMonitor:
+    """
+    Incremental convergence diagnostics of one or more chain files written by
+    `run_chain`. Every `update` reads only the rows appended since the previous
+    call, and updates the running posterior moments (Welford), the
+    autocovariances up to `max_lag` and the Gelman–Rubin :math:`\hat{R}` of
+    every parameter, without re-reading the files.
+
+    Parameters
+    ----------
+    fnames : list of str
+        Paths to the CSV or binary (`.chain`) chain files.
+    max_lag : int
+        Largest lag of the tracked autocovariances, which limits the measurable
+        integrated autocorrelation time.
+    rhat_target : float
+        Convergence requires :math:`\hat{R}` below this for every parameter.
+    tau_factor : float
+        Convergence requires every chain to be longer than `tau_factor` times
+        the integrated autocorrelation time of every parameter.
+    burn : int
+        Number of initial steps of every chain to ignore.
+    """
+    def __init__(self, fnames, max_lag=500, rhat_target=1.01, tau_factor=50, burn=0):
+        self.fnames = list(fnames)
+        self.max_lag = max_lag
+        self.rhat_target = rhat_target
+        self.tau_factor = tau_factor
+        self.burn = burn
+        self.names = None
+        self.chains = [None] * len(self.fnames)
+
+    def _init_chain(self, d):
+        K = self.max_lag + 1
+        return {
+            'offset' : 0, 'skipped' : 0, 'n' : 0,
+            'mean' : np.zeros(d), 'M2' : np.zeros(d),
+            'sum' : np.zeros(d),          # Raw sums for the autocovariances
+            'lagprod' : np.zeros((K, d)), # Sums of x_t * x_{t-k} for every lag k
+            'head' : np.zeros((0, d)),    # First K samples, for the edge corrections
+            'tail' : np.zeros((0, d)),    # Last K samples
+        }
+
+    def _read_new_rows(self, i):
+        fname = self.fnames[i]
+        if not os.path.exists(fname):
+            return None
+        offset = 0 if self.chains[i] is None else self.chains[i]['offset']
+        if fname.endswith(ChainStore.ext):
+            # The offset of a binary chain is the number of rows already seen
+            if os.path.getsize(fname) < 64:
+                return None   # The header is not written yet
+            store = ChainStore(fname)
+            self.names = store.names
+            n_rows = len(store)
+            return n_rows, np.array(store.array()[offset:n_rows])
+        with open(fname, 'rb') as f:
+            f.seek(offset)
+            block = f.read()
+        # Only complete lines are consumed, the rest is read next time
+        end = block.rfind(b'\n') + 1
+        lines = block[:end].splitlines()
+        if offset == 0 and len(lines) > 0:
+            self.names = lines[0].decode().split(',')
+            lines = lines[1:]
+        if len(lines) == 0:
+            # No complete new row since the last poll
+            return offset + end, np.empty((0, 0 if self.names is None else len(self.names)))
+        rows = np.array(b','.join(lines).split(b','), dtype=np.float64)
+        return offset + end, rows.reshape(len(lines), -1)
+
+    def update(self):
+        """Reads the new rows of every chain file and updates the statistics."""
+        for i in range(len(self.fnames)):
+            res = self._read_new_rows(i)
+            if res is None:
+                continue
+            offset, rows = res
+            if self.chains[i] is None:
+                if self.names is None:
+                    continue
+                self.chains[i] = self._init_chain(len(self.names) - 1)
+            c = self.chains[i]
+            c['offset'] = offset
+
+            x = rows[:, :-1]
+            skip = min(max(self.burn - c['skipped'], 0), len(x))
+            c['skipped'] += skip
+            x = x[skip:]
+            if len(x) == 0:
+                continue
+
+            # Running moments of the batch merged into the chain (Chan et al.)
+            n_a, n_b = c['n'], len(x)
+            mean_b = x.mean(axis=0)
+            delta = mean_b - c['mean']
+            c['M2'] += ((x - mean_b)**2).sum(axis=0) + delta**2 * n_a * n_b / (n_a + n_b)
+            c['mean'] += delta * n_b / (n_a + n_b)
+            c['n'] = n_a + n_b
+            c['sum'] += x.sum(axis=0)
+
+            # Lagged products of the new samples with all samples before them
+            K = self.max_lag + 1
+            full = np.concatenate([c['tail'], x])
+            n_prev = len(c['tail'])
+            for k in range(min(K, len(full))):
+                lo = max(n_prev, k)
+                c['lagprod'][k] += (full[lo:] * full[lo-k:len(full)-k]).sum(axis=0)
+            c['tail'] = full[-K:]
+            if len(c['head']) < K:
+                c['head'] = np.concatenate([c['head'], x])[:K]
+
+    def _autocorr(self, c):
+        """Normalized autocorrelation function of a chain from its running sums."""
+        n = c['n']
+        K = min(self.max_lag + 1, n)
+        mu = c['mean']
+        acov = np.zeros((K, len(mu)))
+        for k in range(K):
+            # sum_{t>=k} (x_t - mu)(x_{t-k} - mu), expanded with the raw sums
+            s_late = c['sum'] - c['head'][:k].sum(axis=0)
+            s_early = c['sum'] - c['tail'][len(c['tail'])-k:].sum(axis=0) if k > 0 else c['sum']
+            acov[k] = (c['lagprod'][k] - mu * (s_late + s_early) + (n - k) * mu**2) / n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            acf = acov / acov[0]
+        acf[:, ~np.isfinite(acf[0])] = 0
+        acf[0] = 1
+        return acf
+
+    def tau(self, c=5):
+        """
+        Integrated autocorrelation times of the parameters in every chain,
+        with Sokal's automatic windowing, as an array of shape (N_chains, N_params).
+        """
+        taus = []
+        for ch in self.chains:
+            if ch is None or ch['n'] < 2:
+                continue
+            acf = self._autocorr(ch)
+            cum = 2 * np.cumsum(acf, axis=0) - 1
+            window = np.arange(len(acf))[:, None] >= c * cum
+            M = np.where(window.any(axis=0), window.argmax(axis=0), len(acf) - 1)
+            taus.append(np.maximum(cum[M, np.arange(acf.shape[1])], 1.))
+        return np.array(taus)
+
+    def moments(self):
+        """
+        Running posterior mean and standard deviation of the parameters,
+        pooled over all chains.
+        """
+        chains = [c for c in self.chains if c is not None and c['n'] > 1]
+        n = np.array([c['n'] for c in chains], dtype=np.float64)
+        means = np.array([c['mean'] for c in chains])
+        mean = (n[:, None] * means).sum(axis=0) / n.sum()
+        M2 = sum(c['M2'] for c in chains) + (n[:, None] * (means - mean)**2).sum(axis=0)
+        return mean, np.sqrt(M2 / (n.sum() - 1))
+
+    def rhat(self):
+        """
+        Gelman–Rubin potential scale reduction factor of every parameter. Fixed
+        parameters get :math:`\hat{R} = 1`.
+        """
+        chains = [c for c in self.chains if c is not None and c['n'] > 1]
+        if len(chains) < 2:
+            return None
+        n = np.mean([c['n'] for c in chains])
+        W = np.mean([c['M2'] / (c['n'] - 1) for c in chains], axis=0)
+        B = n * np.var([c['mean'] for c in chains], axis=0, ddof=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            R = np.sqrt(((n - 1) / n * W + B / n) / W)
+        return np.where(W > 0, R, 1.)
+
+    def converged(self):
+        """
+        Returns `True` if :math:`\hat{R}` of every parameter is below the target
+        and every chain is longer than `tau_factor` autocorrelation times.
+        """
+        R = self.rhat()
+        if R is None or np.any(R > self.rhat_target):
+            return False
+        n = np.array([c['n'] for c in self.chains if c is not None and c['n'] > 1])
+        return bool(np.all(n[:, None] > self.tau_factor * self.tau()))
+
+    def summary(self):
+        """Returns the current diagnostics in a dictionary."""
+        mean, std = self.moments()
+        return {
+            'names' : self.names[:-1],
+            'steps' : [0 if c is None else c['n'] for c in self.chains],
+            'mean' : mean, 'std' : std,
+            'rhat' : self.rhat(), 'tau' : self.tau(),
+            'converged' : self.converged(),
+        }
+  ###############################
@@ -0,0 +1,508 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+from itertools import combinations_with_replacement
+from collections import OrderedDict
+
+from cmb_modules import load_spectrum
+
+data = './data/'
+out = './output/'
+
+CMBOutscale = 7.43e12    # Converts the dimensionless CAMB spectra to [micro K^2]
+
+# Order of the cosmological parameters in the parameter vectors
+param_names = ['H0', 'ombh2', 'omch2', 'omk', 'tau', 'ns']
+
+def camb_backend(params, lmax=4400, accuracy=0):
+    """
+    Calculates the lensed :math:`D_{\ell}^{TT}` spectrum of a cosmology with CAMB,
+    the same way as it is done in the MCMC of Part 8.
+
+    Parameters
+    ----------
+    params : numpy.array of shape (6, )
+        The parameter vector `(H0, ombh2, omch2, omk, tau, ns)`.
+    lmax : int
+        Bandlimit of the spectrum.
+    accuracy : int
+        The `lens_potential_accuracy` setting of CAMB.
+
+    Returns
+    -------
+    DlTT : numpy.array of shape (lmax + 1, )
+        The :math:`D_{\ell}^{TT}` spectrum in :math:`\mu K^{2}`, starting from
+        :math:`\ell = 0`.
+    """
+    import camb
+
+    pars = camb.CAMBparams()
+    pars.set_cosmology(H0=params[0], ombh2=params[1], omch2=params[2], omk=params[3], mnu=0.06, tau=params[4])
+    pars.InitPower.set_params(ns=params[5], r=0)
+    pars.set_for_lmax(lmax, lens_potential_accuracy=accuracy)
+
+    results = camb.get_results(pars)
+    totCL = results.get_cmb_power_spectra(pars)['total']
+
+    return totCL[:lmax+1, 0] * CMBOutscale
+
+class TableBackend:
+    """
+    Local stand-in of CAMB, which approximates spectra by linear interpolation
+    (and extrapolation) between a fiducial spectrum file and files calculated
+    with single parameters varied, e.g. the bundled `low_ombh2_scalCls.dat` and
+    `low_omch2_scalCls.dat`. Parameters without a varied file are ignored.
+
+    Parameters
+    ----------
+    fid_params : numpy.array of shape (6, )
+        Parameter vector of the fiducial spectrum.
+    fid_fname : str
+        Path to the fiducial spectrum file.
+    variations : dict
+        Maps the index of a varied parameter to a tuple `(value, fname)`, which
+        contains the value of that parameter in the file `fname`. The rest of
+        the parameters in the file should equal to `fid_params`.
+    """
+    def __init__(self, fid_params, fid_fname, variations):
+        self.fid_params = np.asarray(fid_params, dtype=np.float64)
+        ell, fid = load_spectrum(fid_fname, usecols=(0, 1))
+        self.ell_min = int(ell[0])
+        self.index = sorted(variations)
+        varied = [load_spectrum(variations[i][1], usecols=(1,))[0] for i in self.index]
+
+        # All spectra are cut to the shortest common length
+        n = min([len(fid)] + [len(Dl) for Dl in varied])
+        self.fid = fid[:n]
+        self.slopes = np.array([(Dl[:n] - self.fid) / (variations[i][0] - self.fid_params[i])
+                                for i, Dl in zip(self.index, varied)]).reshape(len(self.index), n)
+
+    def __call__(self, params, lmax=4400, accuracy=0):
+        params = np.asarray(params, dtype=np.float64)
+        dp = params[self.index] - self.fid_params[self.index]
+
+        DlTT = np.zeros(lmax + 1)
+        n = min(len(self.fid), lmax + 1 - self.ell_min)
+        DlTT[self.ell_min:self.ell_min+n] = (self.fid + dp @ self.slopes)[:n]
+
+        return DlTT
+
+    def derivatives(self, lmax=4400):
+        """
+        Returns the finite-difference derivatives of the spectrum by the varied
+        parameters (in the order of `self.index`), with shape (N_varied, lmax + 1).
+        """
+        dDl = np.zeros((len(self.index), lmax + 1))
+        n = min(len(self.fid), lmax + 1 - self.ell_min)
+        dDl[:, self.ell_min:self.ell_min+n] = self.slopes[:, :n]
+
+        return dDl
+  ###############################
+
+def _save_atomic(path, write):
+    """
+    Writes a file through a uniquely named temporary file in the same
+    directory, which is only renamed to `path` after `write(f)` finished.
+    Concurrent writers of the same path (e.g. chains in separate processes)
+    therefore never share, or rename, each other's partial files.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=os.path.basename(path) + '.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class SpectrumProvider:
+    """
+    Memoizing provider of :math:`D_{\ell}^{TT}` spectra. Spectra are keyed on the
+    rounded parameter vector `(H0, ombh2, omch2, omk, tau, ns)`, the bandlimit
+    and the accuracy setting, and are kept in an in-memory LRU cache and,
+    optionally, in an on-disk store. Repeated or nearly identical cosmologies
+    (e.g. rejected proposals or restarted chains) are thus only computed once.
+
+    Parameters
+    ----------
+    backend : callable
+        Function with the signature `backend(params, lmax, accuracy)`, which
+        returns the spectrum from :math:`\ell = 0` to `lmax`. Defaults to
+        `camb_backend`, but e.g. a `TableBackend` can be used in tests.
+    lmax : int
+        Bandlimit of the spectra.
+    accuracy : int
+        Accuracy setting passed to the backend.
+    decimals : list of int
+        Number of decimals to which the parameters are rounded in the keys.
+    maxsize : int
+        Maximum number of spectra in the in-memory cache.
+    cache_dir : str
+        Folder of the on-disk store. If `None`, spectra are not persisted.
+    """
+    def __init__(self, backend=camb_backend, lmax=4400, accuracy=0,
+                 decimals=(3, 6, 6, 5, 5, 5), maxsize=256, cache_dir=None):
+        self.backend = backend
+        self.lmax = lmax
+        self.accuracy = accuracy
+        self.decimals = decimals
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, params):
+        rounded = tuple(round(float(p), d) for p, d in zip(params, self.decimals))
+        return rounded + (self.lmax, self.accuracy)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def __call__(self, params):
+        """
+        Returns the spectrum of a parameter vector, from the memory or the disk
+        if it was already calculated, or from the backend otherwise.
+        """
+        key = self.key(params)
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return self._lru[key]
+
+        path = None if self.cache_dir is None else self._path(key)
+        if path is not None and os.path.exists(path):
+            DlTT = np.load(path)
+            self.hits += 1
+        else:
+            # The rounded parameters are used, so the cached value does not
+            # depend on which of the nearby vectors was evaluated first
+            DlTT = np.asarray(self.backend(np.array(key[:len(params)]), self.lmax, self.accuracy))
+            self.misses += 1
+            if path is not None:
+                _save_atomic(path, lambda f: np.save(f, DlTT))
+
+        DlTT.setflags(write=False)
+        self._lru[key] = DlTT
+        if len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+        return DlTT
+
+    def clear(self):
+        """Empties the in-memory cache. The on-disk store is kept."""
+        self._lru.clear()
+  ###############################
+
+def provider_derivatives(provider, params, steps):
+    """
+    Calculates the derivatives of the spectrum by the parameters with central
+    differences, using a (cached) spectrum provider, e.g. `SpectrumProvider`.
+
+    Parameters
+    ----------
+    provider : callable
+        Returns the spectrum of a parameter vector.
+    params : numpy.array of shape (6, )
+        The fiducial parameter vector.
+    steps : numpy.array of shape (6, )
+        Finite-difference step of every parameter. Parameters with zero
+        step are treated as fixed and left out. If the provider rounds the
+        parameters (it has a `key` method, like `SpectrumProvider`), the
+        differences are divided by the distance of the rounded parameters,
+        and a step that rounds to zero raises a `ValueError`.
+
+    Returns
+    -------
+    index : numpy.array
+        Indices of the parameters with non-zero steps.
+    dDl : numpy.ndarray of shape (len(index), lmax + 1)
+        Derivatives of the spectrum by the parameters in `index`.
+    """
+    params = np.asarray(params, dtype=np.float64)
+    steps = np.asarray(steps, dtype=np.float64)
+    index = np.flatnonzero(steps)
+
+    dDl = []
+    for i in index:
+        dp = np.zeros_like(params)
+        dp[i] = steps[i]
+        h = 2 * steps[i]
+        if hasattr(provider, 'key'):
+            # The provider evaluates the rounded parameters, not the requested ones
+            h = provider.key(params + dp)[i] - provider.key(params - dp)[i]
+            if h == 0:
+                raise ValueError("The step of parameter {0} ({1}) is below the rounding "
+                                 "of the provider".format(i, steps[i]))
+        dDl.append((provider(params + dp) - provider(params - dp)) / h)
+
+    return index, np.array(dDl)
+
+def white_noise_Nl(ell, white_noise_level=10, beam_size_fwhp=1.25):
+    """
+    Beam deconvolved noise spectrum of the white noise in `make_noise_map`,
+    in the same :math:`D_{\ell}` units as the CMB spectra.
+
+    Parameters
+    ----------
+    ell : numpy.array
+        Multipoles of the spectrum.
+    white_noise_level : float
+        Map noise level in :math:`\mu K` arcmin.
+    beam_size_fwhp : float
+        FWHM of the Gaussian beam in arcmin.
+
+    Returns
+    -------
+    DlN : numpy.array
+        The :math:`D_{\ell}` of the noise, divided by the beam window.
+    """
+    ell = np.asarray(ell, dtype=np.float64)
+    arcmin_to_rad = np.pi / 180 / 60
+    beam_sigma = beam_size_fwhp * arcmin_to_rad / np.sqrt(8 * np.log(2))
+    Nl = (white_noise_level * arcmin_to_rad)**2 * np.exp(ell * (ell + 1) * beam_sigma**2)
+
+    return ell * (ell + 1) / (2 * np.pi) * Nl
+
+def fisher_binned(dDl, likelihood):
+    """
+    Fisher matrix of the binned Gaussian likelihood, e.g. `S4TTLikelihood` of
+    the `binned_errors.dat` file, which is
+    .. math::
+                F_{ij} = \sum_{b} \frac{\partial D_{b}}{\partial p_{i}}
+                         \frac{\partial D_{b}}{\partial p_{j}} \frac{1}{\sigma_{b}^{2}}.
+
+    Parameters
+    ----------
+    dDl : numpy.ndarray of shape (N_params, lmax + 1)
+        Derivatives of the spectrum by the parameters.
+    likelihood : S4TTLikelihood
+        Likelihood with the bin indices `idx` and inverse variances `inv_var`.
+
+    Returns
+    -------
+    F : numpy.ndarray of shape (N_params, N_params)
+    """
+    dDb = dDl[:, likelihood.idx]
+
+    return (dDb * likelihood.inv_var) @ dDb.T
+
+def fisher_gaussian(dDl, DlTT, DlN, fsky=1., lmin=2, lmax=None):
+    """
+    Fisher matrix of a full-sky TT measurement with cosmic variance and noise,
+    .. math::
+                F_{ij} = \sum_{\ell} \frac{(2 \ell + 1) f_{sky}}{2}
+                         \frac{\partial_{i} D_{\ell} \partial_{j} D_{\ell}}{(D_{\ell} + N_{\ell})^{2}}.
+
+    Parameters
+    ----------
+    dDl : numpy.ndarray of shape (N_params, lmax + 1)
+        Derivatives of the spectrum by the parameters.
+    DlTT : numpy.array of shape (lmax + 1, )
+        The fiducial :math:`D_{\ell}^{TT}` spectrum.
+    DlN : numpy.array of shape (lmax + 1, )
+        The noise spectrum, e.g. from `white_noise_Nl`, or one measured on
+        `make_noise_map` realizations.
+    fsky : float
+        Observed fraction of the sky.
+    lmin, lmax : int
+        Multipole range of the measurement.
+
+    Returns
+    -------
+    F : numpy.ndarray of shape (N_params, N_params)
+    """
+    lmax = dDl.shape[1] - 1 if lmax is None else lmax
+    ell = np.arange(lmin, lmax + 1)
+    w = (2 * ell + 1) * fsky / 2 / (DlTT[ell] + DlN[ell])**2
+
+    return (dDl[:, ell] * w) @ dDl[:, ell].T
+
+def fisher_covariance(F, priors=None):
+    """
+    Forecasted parameter covariance from a Fisher matrix, optionally with
+    independent Gaussian priors of standard deviations `priors` (use
+    `np.inf` for no prior).
+
+    Returns
+    -------
+    cov : numpy.ndarray of shape (N_params, N_params)
+        The forecasted covariance. The marginalized errors of the parameters
+        are `np.sqrt(np.diag(cov))`.
+    """
+    F = np.array(F, dtype=np.float64)
+    if priors is not None:
+        F += np.diag(1 / np.asarray(priors, dtype=np.float64)**2)
+
+    return np.linalg.inv(F)
+  ###############################
+
+def latin_hypercube(n_samples, bounds, random_seed=None):
+    """
+    Draws a Latin hypercube design inside a parameter box. Every parameter
+    range is split into `n_samples` equal strata, and every stratum is
+    sampled exactly once.
+
+    Parameters
+    ----------
+    n_samples : int
+        Number of design points.
+    bounds : numpy.ndarray of shape (N_params, 2)
+        Lower and upper limits of the parameters. Parameters with equal
+        limits are kept fixed.
+    random_seed : int
+        Seed of the random number generator.
+
+    Returns
+    -------
+    params : numpy.ndarray of shape (n_samples, N_params)
+    """
+    bounds = np.asarray(bounds, dtype=np.float64)
+    rng = np.random.RandomState(random_seed)
+    u = (np.argsort(rng.rand(n_samples, len(bounds)), axis=0) + rng.rand(n_samples, len(bounds))) / n_samples
+
+    return bounds[:, 0] + u * (bounds[:, 1] - bounds[:, 0])
+
+def _backend_job(args):
+    backend, params, lmax, accuracy = args
+    return backend(params, lmax, accuracy)
+
+def build_emulator_table(backend, params, fname, lmax=4400, accuracy=0, n_workers=None):
+    """
+    Evaluates the backend on a set of design points (e.g. from `latin_hypercube`)
+    in parallel worker processes, and saves the training table to the disk.
+
+    Parameters
+    ----------
+    backend : callable
+        Picklable backend, e.g. `camb_backend`.
+    params : numpy.ndarray of shape (N_samples, 6)
+        The design points.
+    fname : str
+        Path to the output `.npz` file.
+    lmax : int
+        Bandlimit of the spectra.
+    accuracy : int
+        Accuracy setting passed to the backend.
+    n_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    spectra : numpy.ndarray of shape (N_samples, lmax + 1)
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    params = np.asarray(params, dtype=np.float64)
+    jobs = [(backend, p, lmax, accuracy) for p in params]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        spectra = np.array(list(pool.map(_backend_job, jobs, chunksize=max(len(jobs) // 64, 1))))
+
+    _save_atomic(fname, lambda f: np.savez(f, params=params, spectra=spectra))
+
+    return spectra
+
+class SpectrumEmulator:
+    """
+    Emulator of :math:`D_{\ell}^{TT}` spectra, trained on a precomputed table of
+    spectra. The spectra are compressed by PCA, and the PCA coefficients are
+    fitted with a polynomial of the parameters, rescaled to the unit box.
+    A batch of spectra is then a single matrix product, which takes much
+    less than a millisecond, instead of a full CAMB run.
+
+    Parameters
+    ----------
+    params : numpy.ndarray of shape (N_samples, N_params)
+        Parameters of the training spectra.
+    spectra : numpy.ndarray of shape (N_samples, lmax + 1)
+        The training spectra.
+    n_components : int
+        Number of kept PCA components.
+    degree : int
+        Degree of the polynomial fitted to the PCA coefficients.
+    """
+    def __init__(self, params, spectra, n_components=16, degree=3):
+        params = np.asarray(params, dtype=np.float64)
+        spectra = np.asarray(spectra, dtype=np.float64)
+        self.degree = degree
+
+        # Fixed parameters are left out from the fit
+        self.lo = params.min(axis=0)
+        self.hi = params.max(axis=0)
+        self.free = self.hi > self.lo
+        self.terms = [t for k in range(degree + 1)
+                      for t in combinations_with_replacement(range(self.free.sum()), k)]
+        assert len(params) >= len(self.terms), f"At least {len(self.terms)} training spectra are needed"
+
+        self.mean = spectra.mean(axis=0)
+        _, _, Vt = np.linalg.svd(spectra - self.mean, full_matrices=False)
+        self.components = Vt[:n_components]
+        coeffs = (spectra - self.mean) @ self.components.T
+        self.weights = np.linalg.lstsq(self._features(params), coeffs, rcond=None)[0]
+
+    @classmethod
+    def from_table(cls, fname, **kwargs):
+        """Trains an emulator on a table saved by `build_emulator_table`."""
+        with np.load(fname) as npz:
+            return cls(npz['params'], npz['spectra'], **kwargs)
+
+    def _features(self, params):
+        x = (params[:, self.free] - self.lo[self.free]) / (self.hi - self.lo)[self.free] * 2 - 1
+        return np.stack([np.prod(x[:, list(t)], axis=1) for t in self.terms], axis=1)
+
+    def __call__(self, params, lmax=None, accuracy=None):
+        """
+        Returns the emulated spectra of one or many parameter vectors, with
+        shape (lmax + 1, ) or (N_models, lmax + 1). The signature matches the
+        backends, thus the emulator can be used by `SpectrumProvider` too.
+        """
+        params = np.asarray(params, dtype=np.float64)
+        single = params.ndim == 1
+        spectra = self.mean + self._features(params.reshape(-1, len(self.lo))) @ self.weights @ self.components
+        if lmax is not None:
+            spectra = spectra[:, :lmax+1]
+
+        return spectra[0] if single else spectra
+
+    def accuracy_report(self, params, spectra, likelihood=None):
+        """
+        Compares the emulator to held-out, directly calculated spectra.
+
+        Parameters
+        ----------
+        params : numpy.ndarray of shape (N_test, N_params)
+            Parameters of the test spectra.
+        spectra : numpy.ndarray of shape (N_test, lmax + 1)
+            The directly calculated test spectra.
+        likelihood : callable
+            If given (e.g. `S4TTLikelihood`), the errors of the log-likelihood
+            caused by the emulation are reported too.
+
+        Returns
+        -------
+        report : dict
+            The RMS and maximal relative errors of the spectra for every
+            multipole, their maxima over the multipoles, and optionally the
+            absolute log-likelihood errors of the test points.
+        """
+        spectra = np.asarray(spectra, dtype=np.float64)
+        emulated = self(np.asarray(params, dtype=np.float64).reshape(len(spectra), -1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rel = np.where(spectra != 0, (emulated - spectra) / spectra, 0.)
+        report = {
+            'rms_rel_error' : np.sqrt(np.mean(rel**2, axis=0)),
+            'max_rel_error' : np.max(np.abs(rel), axis=0),
+        }
+        report['worst_rms_rel_error'] = report['rms_rel_error'].max()
+        report['worst_max_rel_error'] = report['max_rel_error'].max()
+        if likelihood is not None:
+            report['loglike_error'] = np.abs(likelihood(emulated) - likelihood(spectra))
+
+        return report
+  ###############################
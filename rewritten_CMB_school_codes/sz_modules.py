@@ -0,0 +1,595 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from scipy.ndimage import maximum_filter
+from scipy.spatial import cKDTree
+
+from cmb_modules import beta_function
+
+data = './data/'
+out = './output/'
+
+def matched_filter(input_map, beam_and_filt, signal_profile, FT_noise_covar):
+    """
+    Matched filter of Part 5, for a single signal profile.
+
+    Parameters
+    ----------
+    input_map : numpy.ndarray of shape (N_x, N_y)
+        The map we are processing.
+    beam_and_filt : numpy.ndarray of shape (N_x, N_y)
+        The beam convolved with any map filtering, in real space.
+    signal_profile : numpy.ndarray of shape (N_x, N_y)
+        The shape of the signal we are looking for, in real space.
+    FT_noise_covar : numpy.ndarray of shape (N_x, N_y)
+        The :math:`B N_{ap}^{2} + N_{ins}^{2}` in Fourier space.
+
+    Returns
+    -------
+    filtered : numpy.ndarray of shape (N_x, N_y)
+        The filtered map.
+    """
+    FT_beam_and_filt = np.fft.fft2(np.fft.fftshift(beam_and_filt))
+    FT_signal = np.fft.fft2(np.fft.fftshift(signal_profile))
+
+    # Define the matched filter function
+    psi = FT_beam_and_filt * FT_signal / FT_noise_covar
+
+    # Filter the map and center the result
+    filtered = psi * np.fft.fft2(np.fft.fftshift(input_map))
+    filtered = np.real(np.fft.fftshift(np.fft.ifft2(filtered)))
+
+    return filtered
+
+def _full_from_half(half, N_y):
+    """Expands the rfft2 half plane of a symmetric 2D spectrum to the full plane."""
+    full = np.empty((half.shape[0], N_y))
+    full[:, :half.shape[1]] = half
+    # P(-k) = P(k) for the power of a real map
+    j = np.arange(half.shape[1], N_y)
+    i = (-np.arange(half.shape[0])) % half.shape[0]
+    full[:, j] = half[i][:, N_y - j]
+    return full
+
+def radial_smooth(FT_covar, pix_size, delta_ell=50):
+    """
+    Smooths a 2D Fourier space covariance by averaging it in annuli of
+    width `delta_ell`, and interpolating the annular means back to every
+    mode. This removes most of the Monte Carlo noise, but also every
+    anisotropy (e.g. of :math:`1/f` noise).
+
+    Parameters
+    ----------
+    FT_covar : numpy.ndarray of shape (N_x, N_y)
+        The covariance, in the layout of `np.fft.fft2`.
+    pix_size : float
+        Size of a pixel in arcminutes.
+    delta_ell : float
+        Width of the annuli in :math:`\ell`.
+
+    Returns
+    -------
+    smoothed : numpy.ndarray of shape (N_x, N_y)
+    """
+    pix_rad = np.deg2rad(pix_size / 60)
+    kx = np.fft.fftfreq(FT_covar.shape[0], pix_rad)
+    ky = np.fft.fftfreq(FT_covar.shape[1], pix_rad)
+    ell2d = 2 * np.pi * np.sqrt(kx[:, None]**2 + ky[None, :]**2)
+
+    idx = (ell2d / delta_ell).astype(int).ravel()
+    counts = np.bincount(idx)
+    means = np.bincount(idx, FT_covar.ravel()) / np.maximum(counts, 1)
+    centers = np.bincount(idx, ell2d.ravel()) / np.maximum(counts, 1)
+    filled = counts > 0
+
+    return np.interp(ell2d, centers[filled], means[filled])
+
+def estimate_FT_noise_covar(simulate, N_iterations=16, window=None, batch_size=4,
+                            config=None, cache_dir=None, random_seed=0):
+    """
+    Monte Carlo estimate of the 2D Fourier space noise covariance
+    :math:`B N_{ap}^{2} + N_{ins}^{2}` of the matched filter, as it is
+    done in Part 5: the average of :math:`|FT(window \cdot map)|^{2}` over
+    simulated sky plus noise maps. The maps are transformed in batches,
+    and only a running mean is kept in the memory.
+
+    If `cache_dir` is given, the estimate is saved there, under a name
+    derived from `config` and the window. `config` should contain
+    everything the simulations depend on (sky components, beam, noise
+    levels, map size).
+    A later call with the same `config` loads the saved estimate, and if
+    more iterations are requested than what is saved, only the missing ones
+    are simulated and added to the running mean.
+
+    Parameters
+    ----------
+    simulate : callable
+        `simulate(n)` returns `n` simulated maps (sky convolved with the
+        beam, plus noise) in an array of shape (n, N_x, N_y).
+    N_iterations : int
+        Number of simulated maps.
+    window : numpy.ndarray of shape (N_x, N_y)
+        Apodization window applied to the maps, e.g. `cosine_window`.
+    batch_size : int
+        Number of maps transformed at once.
+    config : dict
+        JSON serializable description of the simulations, used as the key
+        of the cache. Required if `cache_dir` is given.
+    cache_dir : str
+        Directory of the cached estimates.
+    random_seed : int
+        The global random state is seeded with `(random_seed, i)` before
+        simulating the i-th map, so the estimate is reproducible, and does
+        not depend on `batch_size`, nor on whether it was extended from a
+        cached estimate or computed at once.
+
+    Returns
+    -------
+    FT_noise_covar : numpy.ndarray of shape (N_x, N_y)
+        The estimated covariance, in the layout of `np.fft.fft2`.
+    """
+    assert N_iterations > 0, "At least one simulated map is needed"
+    if cache_dir is not None and config is None:
+        raise ValueError("`config` is needed to cache the estimate, otherwise "
+                         "different simulations would share the same cache file")
+    fname = None
+    FT_sum, n_done = None, 0
+    if cache_dir is not None:
+        window_hash = None if window is None else hashlib.sha1(
+            np.ascontiguousarray(window, dtype=np.float64).tobytes()).hexdigest()
+        key = json.dumps({'config' : config, 'random_seed' : random_seed,
+                          'window' : window_hash}, sort_keys=True)
+        fname = os.path.join(cache_dir, 'FT_noise_covar_{0}.npz'.format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+        if os.path.exists(fname):
+            with np.load(fname) as npz:
+                FT_sum, n_done, N_y = npz['FT_sum'], int(npz['N_iterations']), int(npz['N_y'])
+            if n_done >= N_iterations:
+                return _full_from_half(FT_sum / n_done, N_y)
+
+    i = n_done
+    while i < N_iterations:
+        n = min(batch_size, N_iterations - i)
+        maps = []
+        for j in range(i, i + n):
+            np.random.seed([random_seed, j])
+            maps.append(np.asarray(simulate(1))[0])
+        maps = np.array(maps)
+        if window is not None:
+            maps *= window
+        FT = np.fft.rfft2(np.fft.fftshift(maps, axes=(-2, -1)))
+        power = (FT.real**2 + FT.imag**2).sum(axis=0)
+        FT_sum = power if FT_sum is None else FT_sum + power
+        N_y = maps.shape[-1]
+        i += n
+
+    if fname is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix=os.path.basename(fname) + '.', suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, FT_sum=FT_sum, N_iterations=N_iterations, N_y=N_y, config=key)
+        os.replace(tmp, fname)
+
+    return _full_from_half(FT_sum / N_iterations, N_y)
+
+def beta_profile_bank(N_x, N_y,
+                      X_width, Y_width, pix_size,
+                      SZ_betas, SZ_theta_cores):
+    """
+    Makes the beta profiles of every combination of the given :math:`\\beta`
+    and core radius values, as templates of a `MatchedFilterBank`.
+
+    Parameters
+    ----------
+    N_x : int
+        Number of pixels in the linear dimension along the X-axis.
+    N_y : int
+        Number of pixels in the linear dimension along the Y-axis.
+    X_width : float
+        Size of the map along the X-axis in degrees.
+    Y_width : float
+        Size of the map along the Y-axis in degrees.
+    pix_size : float
+        Size of a pixel in arcminutes.
+    SZ_betas : array_like
+        The :math:`\\beta` values of the profiles.
+    SZ_theta_cores : array_like
+        The core radii of the profiles in arcminutes.
+
+    Returns
+    -------
+    profiles : numpy.ndarray of shape (N_templates, N_x, N_y)
+        The beta profiles in real space.
+    labels : list of tuples
+        The `(SZ_beta, SZ_theta_core)` pair of every profile.
+    """
+    labels = [(b, t) for b in SZ_betas for t in SZ_theta_cores]
+    profiles = np.array([beta_function(N_x, N_y, X_width, Y_width, pix_size, b, t).T
+                         for b, t in labels])
+
+    return profiles, labels
+
+class MatchedFilterBank:
+    """
+    Bank of matched filters for many signal profiles (e.g. cluster profiles
+    with different core radii and :math:`\\beta` values) with a common beam
+    and noise covariance. The Fourier transforms of the beam and the profiles
+    and the filter functions :math:`\\psi` are computed once, when the bank is
+    made. Every map is then Fourier transformed only once, and every template
+    costs a single inverse FFT. Only real FFTs are used, since the maps and
+    the filters are all real.
+
+    Parameters
+    ----------
+    beam_and_filt : numpy.ndarray of shape (N_x, N_y)
+        The beam convolved with any map filtering, in real space.
+    profiles : numpy.ndarray of shape (N_templates, N_x, N_y)
+        The signal profiles we are looking for, in real space.
+    FT_noise_covar : numpy.ndarray of shape (N_x, N_y)
+        The :math:`B N_{ap}^{2} + N_{ins}^{2}` in Fourier space, as it is
+        returned by `estimate_FT_noise_covar`.
+    labels : list
+        Optional description of every template, e.g. the labels returned
+        by `beta_profile_bank`.
+    """
+    def __init__(self, beam_and_filt, profiles, FT_noise_covar, labels=None):
+        self.shape = beam_and_filt.shape
+        self.labels = labels if labels is not None else list(range(len(profiles)))
+        n_half = self.shape[1]//2 + 1
+
+        self.FT_beam_and_filt = np.fft.rfft2(np.fft.fftshift(beam_and_filt))
+        self.FT_profiles = np.fft.rfft2(np.fft.fftshift(profiles, axes=(-2, -1)))
+        # The noise covariance is symmetric, thus its first half is enough
+        self.FT_noise_covar = np.asarray(FT_noise_covar)[:, :n_half]
+        self.psi = self.FT_beam_and_filt * self.FT_profiles / self.FT_noise_covar
+
+    def __len__(self):
+        return len(self.psi)
+
+    def transform(self, input_map):
+        """Fourier transform of a map, as used by the filters."""
+        return np.fft.rfft2(np.fft.fftshift(input_map))
+
+    def _filter_one(self, FT_map, i):
+        return np.fft.fftshift(np.fft.irfft2(self.psi[i] * FT_map, s=self.shape))
+
+    def filter(self, input_map, SN=True):
+        """
+        Applies every filter of the bank to a map.
+
+        Parameters
+        ----------
+        input_map : numpy.ndarray of shape (N_x, N_y)
+            The map we are processing.
+        SN : bool
+            If `True`, every filtered map is normalized by its standard
+            deviation, to get S/N maps.
+
+        Returns
+        -------
+        filtered : numpy.ndarray of shape (N_templates, N_x, N_y)
+            The filtered maps.
+        """
+        FT_map = self.transform(input_map)
+        filtered = np.empty((len(self),) + self.shape)
+        for i in range(len(self)):
+            filtered[i] = self._filter_one(FT_map, i)
+            if SN:
+                filtered[i] /= np.std(filtered[i])
+
+        return filtered
+
+    def max_SN(self, input_map, sign=1):
+        """
+        Streaming mode of the filter bank. The templates are applied one by
+        one, and only the maximal S/N of every pixel and the index of the
+        template giving it are kept, thus the memory does not grow with the
+        number of templates.
+
+        Parameters
+        ----------
+        input_map : numpy.ndarray of shape (N_x, N_y)
+            The map we are processing.
+        sign : int
+            Use `-1` to look for decrements, like the SZ clusters.
+
+        Returns
+        -------
+        max_SN : numpy.ndarray of shape (N_x, N_y)
+            The maximal S/N of every pixel over the templates, multiplied
+            by `sign`.
+        best : numpy.ndarray of shape (N_x, N_y)
+            Index of the template with the maximal S/N in every pixel.
+            The template itself is `self.labels[best]`.
+        """
+        FT_map = self.transform(input_map)
+        max_SN = np.full(self.shape, -np.inf)
+        best = np.zeros(self.shape, dtype=np.int32)
+        for i in range(len(self)):
+            SN_map = self._filter_one(FT_map, i)
+            SN_map *= sign / np.std(SN_map)
+            better = SN_map > max_SN
+            max_SN[better] = SN_map[better]
+            best[better] = i
+
+        return max_SN, best
+  ###############################
+
+def stack_on_positions(Map, cat, radius, bins=None, column=2,
+                       boundary='drop', method='fft', batch_size=None):
+    """
+    Stacks `(2 radius, 2 radius)` cutouts of a map on the positions of a
+    catalogue, optionally in bins of one of the catalogue columns (e.g. the
+    amplitude of the SZ clusters). With `boundary='drop'` and a single bin
+    `(bin_min, bin_max]` the result is the same as `Stack_on_Positions` of
+    Part 5.
+
+    The objects are first sorted into bins, then the stacks of all the bins
+    are computed at once by one of two methods:
+
+    - `'fft'`: the catalogue of every bin is binned into a count map, and the
+      stack is the cross-correlation of the map with the count map, computed
+      with FFTs. The cost does not depend on the number of objects, so this
+      is the method for large catalogues (:math:`10^{5}` objects).
+    - `'cutouts'`: the cutouts of a batch of objects are extracted at once
+      from a strided view of the map, and summed per bin with a single
+      matrix product. This is faster for small catalogues and radii.
+
+    Parameters
+    ----------
+    Map : numpy.ndarray of shape (N_x, N_y)
+        The map to stack.
+    cat : numpy.ndarray of shape (N_columns, N_objects)
+        The catalogue, with the X and Y pixel coordinates of the objects in
+        the first two rows, like `SZcat`. Fractional coordinates are
+        truncated. Coordinates outside the map are wrapped, except with
+        `boundary='drop'`.
+    radius : int
+        Half size of the cutouts in pixels.
+    bins : array_like
+        Edges of the bins of `cat[column]`. An object falls into the bin
+        `(bins[i], bins[i+1]]`. If `None`, every object is stacked together.
+    column : int
+        Row of the catalogue used for the binning.
+    boundary : str
+        Treatment of the objects close to the edge of the map. `'drop'`
+        skips them, `'periodic'` wraps the cutouts around the map, and
+        `'zero'` pads the map with zeros.
+    method : str
+        `'fft'` or `'cutouts'`, see above.
+    batch_size : int
+        Number of cutouts extracted at once by the `'cutouts'` method.
+        By default a batch takes about 64 MB.
+
+    Returns
+    -------
+    mean : numpy.ndarray of shape (N_bins, 2 radius, 2 radius)
+        The stacked mean of every bin. The first axis is missing if
+        `bins` is `None`.
+    var : numpy.ndarray of shape (N_bins, 2 radius, 2 radius)
+        The variance of the cutouts of every bin in every pixel.
+    counts : numpy.ndarray of shape (N_bins, )
+        The number of stacked objects in every bin.
+    """
+    radius = int(radius)
+    N_x, N_y = Map.shape
+    xc = cat[0].astype(int)
+    yc = cat[1].astype(int)
+
+    # Bin index of every object
+    if bins is None:
+        idx = np.zeros(len(xc), dtype=int)
+        N_bins = 1
+    else:
+        idx = np.digitize(cat[column], bins, right=True) - 1
+        N_bins = len(bins) - 1
+    keep = (idx >= 0) & (idx < N_bins)
+
+    if boundary == 'drop':
+        # The edge test is done on the untruncated coordinates, like in Part 5
+        keep &= ((cat[0] > radius) & (cat[0] < N_x - radius)
+                 & (cat[1] > radius) & (cat[1] < N_y - radius))
+    elif boundary not in ('periodic', 'zero'):
+        raise ValueError("boundary must be 'drop', 'periodic' or 'zero'")
+    xc, yc, idx = xc[keep] % N_x, yc[keep] % N_y, idx[keep]
+    counts = np.bincount(idx, minlength=N_bins)
+
+    if boundary == 'zero' or (boundary == 'drop' and method == 'cutouts'):
+        Map = np.pad(Map, radius)
+        xc, yc = xc + radius, yc + radius
+    elif boundary == 'periodic' and method == 'cutouts':
+        Map = np.pad(Map, radius, mode='wrap')
+        xc, yc = xc + radius, yc + radius
+
+    if method == 'fft':
+        # Count maps of the bins, all with one bincount
+        flat = (idx * Map.shape[0] + xc) * Map.shape[1] + yc
+        count_maps = np.bincount(flat, minlength=N_bins*Map.size).reshape((N_bins,) + Map.shape)
+        FT_counts = np.conj(np.fft.rfft2(count_maps))
+        # Cross-correlations, with the zero shift moved to the center
+        sums = np.fft.irfft2(np.fft.rfft2(Map) * FT_counts, s=Map.shape)
+        sums2 = np.fft.irfft2(np.fft.rfft2(Map**2) * FT_counts, s=Map.shape)
+        sums = np.roll(sums, (radius, radius), axis=(1, 2))[:, :2*radius, :2*radius]
+        sums2 = np.roll(sums2, (radius, radius), axis=(1, 2))[:, :2*radius, :2*radius]
+    elif method == 'cutouts':
+        # Strided view of every cutout of the map, indexed by its corner
+        windows = np.lib.stride_tricks.sliding_window_view(Map, (2*radius, 2*radius))
+        if batch_size is None:
+            batch_size = max(1, 2**23 // (2*radius)**2)
+        sums = np.zeros((N_bins, (2*radius)**2))
+        sums2 = np.zeros((N_bins, (2*radius)**2))
+        for i in range(0, len(xc), batch_size):
+            cutouts = windows[xc[i:i+batch_size] - radius, yc[i:i+batch_size] - radius]
+            cutouts = cutouts.reshape(len(cutouts), -1)
+            # One-hot matrix of the bins: the grouped sums are a single product
+            onehot = np.zeros((N_bins, len(cutouts)))
+            onehot[idx[i:i+batch_size], np.arange(len(cutouts))] = 1
+            sums += onehot @ cutouts
+            sums2 += onehot @ cutouts**2
+        sums = sums.reshape(N_bins, 2*radius, 2*radius)
+        sums2 = sums2.reshape(N_bins, 2*radius, 2*radius)
+    else:
+        raise ValueError("method must be 'fft' or 'cutouts'")
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts[:, None, None]
+        var = sums2 / counts[:, None, None] - mean**2
+
+    if bins is None:
+        return mean[0], var[0], counts[0]
+    return mean, var, counts
+  ###############################
+
+def find_peaks(SN_map, threshold=5., size=3, sign=1, periodic=False):
+    """
+    Finds the sources on a (matched filtered) S/N map as the local maxima
+    above a threshold, and makes a catalogue of them in the format of
+    `SZcat`. The local maxima are found with a single maximum filter, and
+    their positions are refined to sub-pixel precision by fitting a parabola
+    through the peak and its neighbours along both axes.
+
+    Parameters
+    ----------
+    SN_map : numpy.ndarray of shape (N_x, N_y)
+        The S/N map, e.g. from `MatchedFilterBank.max_SN`.
+    threshold : float
+        Minimal S/N of the detections.
+    size : int
+        Size of the neighbourhood, in which a peak has to be the maximum.
+    sign : int
+        Use `-1` to look for decrements, like the SZ clusters.
+    periodic : bool
+        Whether the map wraps around at its edges.
+
+    Returns
+    -------
+    detections : numpy.ndarray of shape (3, N_detections)
+        The X and Y pixel coordinates and the S/N of the detections,
+        ordered by decreasing significance.
+    """
+    SN = sign * SN_map
+    mode = 'wrap' if periodic else 'nearest'
+    peaks = (SN == maximum_filter(SN, size=size, mode=mode)) & (SN >= threshold)
+    xp, yp = np.nonzero(peaks)
+
+    # Parabolic sub-pixel refinement along both axes
+    N_x, N_y = SN.shape
+    shifts = []
+    for axis, (p, N) in enumerate(((xp, N_x), (yp, N_y))):
+        lo = (p - 1) % N if periodic else np.maximum(p - 1, 0)
+        hi = (p + 1) % N if periodic else np.minimum(p + 1, N - 1)
+        f_lo = SN[lo, yp] if axis == 0 else SN[xp, lo]
+        f_hi = SN[hi, yp] if axis == 0 else SN[xp, hi]
+        curv = f_lo - 2*SN[xp, yp] + f_hi
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shift = np.where(curv < 0, 0.5 * (f_lo - f_hi) / curv, 0.)
+        shifts.append(np.clip(shift, -0.5, 0.5))
+
+    detections = np.array([xp + shifts[0], yp + shifts[1], SN_map[xp, yp]])
+    order = np.argsort(-sign * detections[2])
+
+    return detections[:, order]
+
+def crossmatch(detections, cat, max_dist=2., boxsize=None):
+    """
+    Matches a catalogue of detections to an input catalogue (e.g. `SZcat`)
+    with a KD-tree of the input positions. Every detection is matched to the
+    closest input object within `max_dist` pixels.
+
+    Parameters
+    ----------
+    detections : numpy.ndarray of shape (N_columns, N_detections)
+        The detections, with X and Y pixel coordinates in the first two
+        rows, as returned by `find_peaks`.
+    cat : numpy.ndarray of shape (N_columns, N_objects)
+        The input catalogue, in the same format.
+    max_dist : float
+        Maximal distance of matching objects in pixels.
+    boxsize : tuple of float
+        The shape of the map, if the map is periodic.
+
+    Returns
+    -------
+    match : numpy.ndarray of shape (N_detections, )
+        Index of the input object matched to every detection, or -1.
+    dist : numpy.ndarray of shape (N_detections, )
+        Distance to the matched object, or `inf`.
+    """
+    pos = np.asarray(cat[:2], dtype=np.float64).T
+    if boxsize is not None:
+        pos = pos % boxsize
+    tree = cKDTree(pos, boxsize=boxsize)
+    det = np.asarray(detections[:2], dtype=np.float64).T
+    if boxsize is not None:
+        det = det % boxsize
+    dist, match = tree.query(det, k=1, distance_upper_bound=max_dist)
+    match[~np.isfinite(dist)] = -1
+
+    return match, dist
+
+def completeness_purity(detections, cat, thresholds, max_dist=2., boxsize=None,
+                        bins=None, column=2):
+    """
+    Counts the matched input objects and detections of a single realization
+    above a series of S/N thresholds. The counts can be summed over many
+    Monte Carlo realizations; the completeness is then
+    `found.sum(0) / total.sum(0)`, and the purity is
+    `matched.sum(0) / detected.sum(0)`.
+
+    Parameters
+    ----------
+    detections : numpy.ndarray of shape (3, N_detections)
+        The detections of `find_peaks`, with their S/N in the third row.
+    cat : numpy.ndarray of shape (N_columns, N_objects)
+        The input catalogue.
+    thresholds : array_like
+        The S/N thresholds. The absolute value of the S/N is compared to
+        them, thus decrements work too.
+    max_dist : float
+        Maximal distance of matching objects in pixels.
+    boxsize : tuple of float
+        The shape of the map, if the map is periodic.
+    bins : array_like
+        Edges of bins of `cat[column]` (e.g. the amplitude), in which the
+        completeness is counted separately.
+    column : int
+        Row of the catalogue used for the binning.
+
+    Returns
+    -------
+    counts : dict
+        `found` and `total` (of shape (N_bins, N_thresholds), or
+        (N_thresholds, ) without `bins`): the number of input objects
+        matched by a detection above the threshold, and all of them.
+        `matched` and `detected` (of shape (N_thresholds, )): the number of
+        detections above the threshold with and without a match.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    match, _ = crossmatch(detections, cat, max_dist, boxsize)
+    SN = np.abs(detections[2])
+
+    # The most significant detection of every input object
+    best = np.zeros(cat.shape[1])
+    np.maximum.at(best, match[match >= 0], SN[match >= 0])
+    found = best[:, None] >= thresholds
+
+    above = SN[:, None] >= thresholds
+    counts = {
+        'matched' : (above & (match >= 0)[:, None]).sum(axis=0),
+        'detected' : above.sum(axis=0),
+    }
+    if bins is None:
+        counts['found'] = found.sum(axis=0)
+        counts['total'] = np.full(len(thresholds), cat.shape[1])
+    else:
+        idx = np.digitize(cat[column], bins, right=True) - 1
+        N_bins = len(bins) - 1
+        keep = (idx >= 0) & (idx < N_bins)
+        onehot = np.zeros((N_bins, cat.shape[1]), dtype=int)
+        onehot[idx[keep], np.nonzero(keep)[0]] = 1
+        counts['found'] = onehot @ found
+        counts['total'] = np.repeat(onehot.sum(axis=1)[:, None], len(thresholds), axis=1)
+
+    return counts
+  ###############################
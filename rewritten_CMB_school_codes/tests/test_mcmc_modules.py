@@ -0,0 +1,27 @@
+import numpy as np
+
+from mcmc_modules import ChainMonitor, GaussianProposal, run_chain
+
+
+def loglike(x):
+    return -0.5 * np.sum(x**2)
+
+
+def test_monitor_polls_chain_without_new_rows(tmp_path):
+    fname = str(tmp_path / 'chain.csv')
+    proposal = GaussianProposal(np.full(6, 0.5))
+    run_chain(loglike, np.zeros(6), proposal, 50, fname, seed=0)
+
+    monitor = ChainMonitor([fname], max_lag=10)
+    monitor.update()
+    assert monitor.chains[0]['n'] == 50
+
+    # Nothing was appended since the last poll
+    monitor.update()
+    assert monitor.chains[0]['n'] == 50
+
+    # A partially written row is not consumed either
+    with open(fname, 'a') as f:
+        f.write('1.0,2.0')
+    monitor.update()
+    assert monitor.chains[0]['n'] == 50
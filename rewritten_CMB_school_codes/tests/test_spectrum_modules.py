@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from spectrum_modules import SpectrumProvider, provider_derivatives
+
+
+def linear_backend(params, lmax=4400, accuracy=0):
+    # Spectrum linear in the parameters, so the exact derivative is known
+    return np.outer(np.arange(1, 7), np.ones(lmax + 1)).T @ params
+
+
+def test_derivatives_with_non_representable_step():
+    provider = SpectrumProvider(backend=linear_backend, lmax=10)
+    params = np.array([67.5, 0.022, 0.122, 0.06, 2.1, 0.965])
+    steps = np.array([0.0007, 0.0000015, 0., 0., 0., 0.])
+    index, dDl = provider_derivatives(provider, params, steps)
+    assert list(index) == [0, 1]
+    assert np.allclose(dDl, np.array([[1.] * 11, [2.] * 11]))
+
+
+def test_derivatives_reject_step_below_rounding():
+    provider = SpectrumProvider(backend=linear_backend, lmax=10)
+    params = np.array([67.5, 0.022, 0.122, 0.06, 2.1, 0.965])
+    with pytest.raises(ValueError):
+        provider_derivatives(provider, params, [0.0001, 0., 0., 0., 0., 0.])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from sz_modules import estimate_FT_noise_covar, stack_on_positions
+
+
+def Stack_on_Positions(map, N, cat, N_objects, bin_min, bin_max, Radius):
+    # The stacking routine of Part 5
+    Radius = int(Radius)
+    stack = np.zeros([Radius*2, Radius*2])
+    counter = 0
+    for i in range(N_objects):
+        ampl = cat[2, i]
+        if (ampl > bin_min) and (ampl <= bin_max):
+            xc = cat[0, i]
+            yc = cat[1, i]
+            if (xc > Radius) and (xc < N-Radius):
+                if (yc > Radius) and (yc < N-Radius):
+                    stack += map[int(xc-Radius):int(xc+Radius), int(yc-Radius):int(yc+Radius)]
+                    counter += 1
+    return stack/counter, counter
+
+
+@pytest.mark.parametrize('method', ['fft', 'cutouts'])
+def test_stack_matches_part5_on_fractional_positions(method):
+    rng = np.random.RandomState(0)
+    N, radius, N_objects = 128, 10, 300
+    Map = rng.standard_normal((N, N))
+    cat = np.array([rng.uniform(0, N, N_objects), rng.uniform(0, N, N_objects),
+                    rng.uniform(-1, 1, N_objects)])
+    # Objects just inside the edges, which truncation to int would drop
+    cat[0, :4] = [radius + 0.5, N - radius - 0.5, 50.3, 60.7]
+    cat[1, :4] = [40.2, 70.9, radius + 0.25, N - radius - 0.75]
+
+    ref, ref_count = Stack_on_Positions(Map, N, cat, N_objects, -0.5, 1, radius)
+    mean, var, counts = stack_on_positions(Map, cat, radius, bins=[-0.5, 1],
+                                           boundary='drop', method=method)
+    assert counts[0] == ref_count
+    np.testing.assert_allclose(mean[0], ref, atol=1e-10)
+
+
+def test_noise_covar_cache_needs_config(tmp_path):
+    with pytest.raises(ValueError):
+        estimate_FT_noise_covar(lambda n: np.zeros((n, 8, 8)), N_iterations=1,
+                                cache_dir=str(tmp_path))